@@ -0,0 +1,211 @@
+import asyncio
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+from lib import deadline
+from lib import metrics
+
+logger = logging.getLogger(__name__)
+
+# Renders allowed to run at once, across all requests of this process
+RENDER_SLOTS = int(os.getenv("RENDER_SLOTS", str(os.cpu_count() or 2)))
+# Requests allowed to wait for a slot; anything beyond gets 429 right away
+RENDER_QUEUE_SIZE = int(os.getenv("RENDER_QUEUE_SIZE", str(2 * RENDER_SLOTS)))
+# Longest time (seconds) a request waits in the queue before it gets 429
+RENDER_QUEUE_TIMEOUT = float(os.getenv("RENDER_QUEUE_TIMEOUT", "30"))
+
+
+class Saturated(Exception):
+    """
+    Raised when no slot is free and the wait queue is full (or the wait timed out).
+    `retry_after` is the suggested number of seconds before trying again.
+    """
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Lease:
+    """
+    One held slot. release() is thread-safe and only acts once, so the thread doing the work can
+    give the slot back when it really stops, even if the request that took it was cancelled earlier.
+    """
+    def __init__(self, admission: "Admission"):
+        self._admission = admission
+        self._lock = threading.Lock()
+        self._held = True
+        self.started = time.monotonic()
+
+    def release(self):
+        with self._lock:
+            if not self._held:
+                return
+            self._held = False
+        self._admission.release(time.monotonic() - self.started)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class _Waiter:
+    # A queued acquire: a future on the caller's event loop, or an Event for a worker thread
+    def __init__(self, loop: asyncio.AbstractEventLoop = None):
+        self.granted = False
+        self.loop = loop
+        self.future = loop.create_future() if loop else None
+        self.event = None if loop else threading.Event()
+
+    def grant(self):
+        if self.loop:
+            self.loop.call_soon_threadsafe(self._resolve)
+        else:
+            self.event.set()
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class Admission:
+    """
+    Counting semaphore with a bounded FIFO wait queue, shared by event-loop requests (acquire/slot)
+    and worker threads (acquire_blocking/hold). A released slot is handed straight to the oldest
+    waiter, so newcomers cannot jump the queue.
+    """
+    def __init__(self, name: str, slots: int, queue_size: int, queue_timeout: float):
+        self.name = name
+        self.slots = slots
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self._lock = threading.Lock()
+        self._waiters = deque()
+        # Moving average of how long a slot is held, for Retry-After
+        self._hold_time = 1.0
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def retry_after(self) -> int:
+        # Roughly the time until everyone queued now has been served
+        return max(1, math.ceil(self._hold_time * (self.queued + 1) / self.slots))
+
+    def _reject(self, reason: str):
+        metrics.inc("admission_rejected_total", pool=self.name, reason=reason)
+        logger.warning(f"{self.name}: rejecting request ({reason}), {self.active} running, {self.queued} queued")
+        raise Saturated(f"Server busy ({reason}), try again later", self.retry_after())
+
+    def check(self):
+        """
+        Raise Saturated now if a new request could not even be queued.
+        """
+        if self.active >= self.slots and self.queued >= self.queue_size:
+            self._reject("queue full")
+
+    def _enqueue(self, waiter: _Waiter, bounded: bool = True) -> bool:
+        # True if a free slot was taken; False if queued. Raises Saturated when the queue is full.
+        with self._lock:
+            if self.active < self.slots and not self._waiters:
+                self.active += 1
+                return True
+            full = bounded and len(self._waiters) >= self.queue_size
+            if not full:
+                self._waiters.append(waiter)
+                return False
+        self._reject("queue full")
+
+    def _give_up(self, waiter: _Waiter):
+        # Leave the queue; if the slot was handed over meanwhile, pass it on
+        with self._lock:
+            granted = waiter.granted
+            if not granted:
+                self._waiters.remove(waiter)
+        if granted:
+            self.release()
+
+    async def acquire(self) -> Lease:
+        waiter = _Waiter(asyncio.get_running_loop())
+        if self._enqueue(waiter):
+            return Lease(self)
+
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(waiter.future, self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            self._give_up(waiter)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self._reject("queue timeout")
+        finally:
+            metrics.observe("admission_wait_seconds", time.monotonic() - started, pool=self.name)
+        return Lease(self)
+
+    def acquire_blocking(self) -> Lease:
+        """
+        Acquire from a worker thread for background work (jobs). Background work is never
+        refused: it queues even past queue_size and waits as long as it takes, unless the
+        current deadline scope (lib.deadline) runs out or is cancelled.
+        """
+        waiter = _Waiter()
+        if self._enqueue(waiter, bounded=False):
+            return Lease(self)
+
+        started = time.monotonic()
+        try:
+            while not waiter.event.wait(1.0):
+                deadline.check(f"{self.name} slot")
+        except BaseException:
+            self._give_up(waiter)
+            raise
+        finally:
+            metrics.observe("admission_wait_seconds", time.monotonic() - started, pool=self.name)
+        return Lease(self)
+
+    def release(self, held: float = None):
+        """
+        Give a slot back (any thread). Prefer Lease.release(), which cannot release twice.
+        """
+        with self._lock:
+            if held is not None:
+                self._hold_time = 0.8 * self._hold_time + 0.2 * held
+            if not self._waiters:
+                self.active -= 1
+                return
+            waiter = self._waiters.popleft()
+            waiter.granted = True
+        waiter.grant()
+
+    @asynccontextmanager
+    async def slot(self):
+        """
+        async with admission.slot(): ... runs the block holding one slot, or raises Saturated.
+        """
+        lease = await self.acquire()
+        try:
+            yield lease
+        finally:
+            lease.release()
+
+    @contextmanager
+    def hold(self):
+        """
+        with admission.hold(): ... the same from a worker thread, see acquire_blocking().
+        """
+        with self.acquire_blocking() as lease:
+            yield lease
+
+
+# Shared by every endpoint that renders posters
+render = Admission("render", RENDER_SLOTS, RENDER_QUEUE_SIZE, RENDER_QUEUE_TIMEOUT)
+
+
+__all__ = ["RENDER_SLOTS", "RENDER_QUEUE_SIZE", "RENDER_QUEUE_TIMEOUT", "Saturated", "Lease", "Admission", "render"]
@@ -1,9 +1,13 @@
 from typing import List, Dict, Any
+from psycopg.errors import QueryCanceled
 from psycopg.rows import dict_row
-from psycopg_pool import ConnectionPool
+from psycopg_pool import ConnectionPool, PoolTimeout
 from contextlib import contextmanager
+from lib import deadline
+from lib import metrics
 import logging
 import os
+import time
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -16,10 +20,16 @@ DATABASE_URL = os.getenv(
 )
 pool: ConnectionPool = ConnectionPool(conninfo=DATABASE_URL, min_size=1, max_size=10)
 
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+
 # Context manager for database connections: Get a connection from the pool
 @contextmanager
 def _get_db_connection() -> Any:
-    conn = pool.getconn()
+    started = time.perf_counter()
+    try:
+        conn = pool.getconn(timeout=deadline.clamp(POOL_TIMEOUT, "database connection"))
+    finally:
+        metrics.observe("db_pool_wait_seconds", time.perf_counter() - started)
     try:
         logger.info("Databse Connected")
         yield conn  # <-- give back the connection to the caller
@@ -31,17 +41,54 @@ def execute_query(query: str, params: tuple = ()) -> List[Dict[str, Any]]:
     """
     Execute a SQL query and return results as list of dictionaries.
     Uses connection pooling for efficiency.
+    Within a request deadline the query gets a statement_timeout of the remaining budget,
+    and DeadlineExceeded is raised (instead of returning []) once the budget is spent, whether
+    waiting for a pooled connection or running the query.
     """
     logger.info(f"Executing query: {query} with params: {params}")
+    deadline.check("database query")
     try:    
         with _get_db_connection() as conn:
             with conn.cursor(row_factory=dict_row) as cur:
-                cur.execute(query, params)
-                results = cur.fetchall()
+                left = deadline.remaining()
+                if left is not None:
+                    # Transaction-local, so it does not stick to the pooled connection
+                    cur.execute("SELECT set_config('statement_timeout', %s, true)", (str(max(1, int(left * 1000))),))
+                started = time.perf_counter()
+                status = "error"
+                try:
+                    cur.execute(query, params)
+                    results = cur.fetchall()
+                    status = "ok"
+                finally:
+                    metrics.observe("db_query_duration_seconds", time.perf_counter() - started, status=status)
                 return results
+    except deadline.DeadlineExceeded:
+        raise
+    except QueryCanceled as e:
+        if deadline.remaining() is not None:
+            # statement_timeout from the request deadline, not a query problem
+            raise deadline.DeadlineExceeded(f"Deadline exceeded during database query: {e}")
+        logger.error(f"Error executing query: {e}")
+        metrics.inc("db_errors_total")
+        return []
+    except PoolTimeout as e:
+        if deadline.remaining() is not None:
+            # getconn() timeout was shortened to the remaining budget
+            raise deadline.DeadlineExceeded(f"Deadline exceeded waiting for a database connection: {e}")
+        logger.error(f"Error executing query: {e}")
+        metrics.inc("db_errors_total")
+        return []
     except Exception as e:
         logger.error(f"Error executing query: {e}")
+        metrics.inc("db_errors_total")
         return []
 
-__all__ = ["execute_query"]  # only this is public
+def pool_stats() -> Dict[str, int]:
+    """
+    Current connection pool counters (pool_size, pool_available, requests_waiting...).
+    """
+    return pool.get_stats()
+
+__all__ = ["execute_query", "pool_stats"]  # only these are public
 
@@ -0,0 +1,81 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+# Absolute time.monotonic() by which the current request must be finished (None = no deadline)
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("deadline", default=None)
+# Set when whoever waits for the current work has gone away (e.g. the HTTP client disconnected)
+_cancel: contextvars.ContextVar[Optional[threading.Event]] = contextvars.ContextVar("cancel", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when a stage starts (or would wait) after the request's time budget is used up.
+    """
+
+
+class Cancelled(DeadlineExceeded):
+    """
+    Raised when a stage starts after the work was cancelled, so nothing is left to wait for it.
+    """
+
+
+@contextmanager
+def scope(at: float = None, seconds: float = None, cancel: threading.Event = None):
+    """
+    Set the deadline for the code inside the block, either as an absolute monotonic time `at`
+    or as `seconds` from now. A nested scope can only shorten the outer deadline.
+    `cancel` is an Event another thread sets to stop the work at its next check().
+    Contextvars are not inherited by plain thread pools, so pass `at`/`cancel` into worker threads.
+    """
+    if at is None and seconds is not None:
+        at = time.monotonic() + seconds
+    outer = _deadline.get()
+    if outer is not None and (at is None or outer < at):
+        at = outer
+    token = _deadline.set(at)
+    cancel_token = _cancel.set(cancel) if cancel is not None else None
+    try:
+        yield at
+    finally:
+        if cancel_token is not None:
+            _cancel.reset(cancel_token)
+        _deadline.reset(token)
+
+
+def current() -> Optional[float]:
+    return _deadline.get()
+
+
+def remaining() -> Optional[float]:
+    """
+    Seconds left in the budget, or None without a deadline.
+    """
+    at = _deadline.get()
+    return None if at is None else at - time.monotonic()
+
+
+def check(stage: str):
+    """
+    Fail fast before starting `stage` if the work was cancelled or the budget is already spent.
+    """
+    cancel = _cancel.get()
+    if cancel is not None and cancel.is_set():
+        raise Cancelled(f"Cancelled before {stage}")
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded(f"Deadline exceeded before {stage}")
+
+
+def clamp(seconds: float, stage: str) -> float:
+    """
+    The smaller of `seconds` and the remaining budget, for per-call timeouts.
+    """
+    check(stage)
+    left = remaining()
+    return seconds if left is None else min(seconds, left)
+
+
+__all__ = ["DeadlineExceeded", "Cancelled", "scope", "current", "remaining", "check", "clamp"]
@@ -1,50 +1,132 @@
-import json
+import logging
 import os
-import requests
+import threading
+import time
 from lib.db_manager import execute_query
+from lib import page_store
+from lib import singleflight
 
-def get_page_access_token(school_id: str, pages_file="fb_pages.json"):
+logger = logging.getLogger(__name__)
+
+# How long resolved facebook_page_id values are trusted before re-querying (seconds)
+PAGE_ID_TTL = float(os.getenv("PAGE_ID_TTL", "600"))
+
+_page_ids_lock = threading.Lock()
+# school_id -> facebook_page_id (None when the school has none), and when it was loaded
+_page_ids = {}
+_page_ids_loaded_at = 0.0
+
+
+def _school_schemas() -> list:
+    # Every schema whose configurations table has the columns the page id query reads is a school;
+    # one schema without them would make the whole UNION ALL fail
+    rows = execute_query("""
+        SELECT table_schema FROM information_schema.columns
+        WHERE table_name = 'configurations' AND column_name IN ('_school', 'config_key', 'config_value')
+        GROUP BY table_schema
+        HAVING COUNT(DISTINCT column_name) = 3
+    """)
+    return [row["table_schema"] for row in rows]
+
+
+def resolve_page_ids(school_ids: list = None) -> dict:
     """
-    Fetch the Facebook Page ID from the configurations table, and get the matching access token
-    from fb_pages.json. If fb_pages.json doesn't exist, create it by calling Graph API once.
+    Fetch facebook_page_id for every school (all school schemas by default) in one UNION ALL query
+    and cache the mapping for PAGE_ID_TTL seconds. Returns {school_id: page_id or None}.
     """
-    # 1️⃣ Get the facebook_page_id from configurations
-    query = """
-        SELECT config_value AS facebook_page_id
+    global _page_ids_loaded_at
+    school_ids = school_ids or _school_schemas()
+    if not school_ids:
+        return {}
+
+    query = " UNION ALL ".join(
+        """
+        (SELECT %s AS school_id, config_value AS facebook_page_id
         FROM {0}.configurations
         WHERE config_key = 'facebook_page_id'
         AND _school = %s
-        LIMIT 1
-    """.format(school_id)
+        LIMIT 1)
+        """.format(school_id)
+        for school_id in school_ids
+    )
+    params = tuple(value for school_id in school_ids for value in (school_id, school_id))
+    rows = execute_query(query, params)
+
+    resolved = {school_id: None for school_id in school_ids}
+    if not rows:
+        # execute_query returns [] on database errors too: don't cache "no page" for everyone
+        logger.warning(f"No facebook_page_id rows for {len(school_ids)} schools, not caching")
+        return resolved
+    for row in rows:
+        resolved[row["school_id"]] = str(row["facebook_page_id"])
 
-    result = execute_query(query, (school_id,))
-    if not result:
+    with _page_ids_lock:
+        _page_ids.update(resolved)
+        _page_ids_loaded_at = time.monotonic()
+    for school_id, page_id in resolved.items():
+        if page_id:
+            page_store.set_school_page_id(school_id, page_id)
+    logger.info(f"Resolved facebook_page_id for {len(school_ids)} schools in one query")
+    return resolved
+
+
+def get_page_id(school_id: str) -> str:
+    """
+    facebook_page_id for a school. The first miss (or the first call after PAGE_ID_TTL) resolves
+    every school at once, so a multi-school run does a single configuration query.
+    """
+    with _page_ids_lock:
+        fresh = time.monotonic() - _page_ids_loaded_at < PAGE_ID_TTL
+        cached = fresh and school_id in _page_ids
+        page_id = _page_ids.get(school_id) if cached else None
+
+    if not cached:
+        resolved = resolve_page_ids()
+        if school_id not in resolved or not any(resolved.values()):
+            # Not discovered as a school schema, or the bulk query failed: look it up on its own
+            resolved = resolve_page_ids([school_id])
+        page_id = resolved.get(school_id)
+    if page_id is None:
+        # Database unavailable or no configuration: fall back to the last known mapping
+        page_id = page_store.get_school_page_id(school_id)
+    if page_id is None:
         raise Exception(f"No facebook_page_id found in configurations for {school_id}")
+    return page_id
 
-    page_id = str(result[0]["facebook_page_id"])
 
-    # 2️⃣ If fb_pages.json doesn't exist, fetch it from Facebook Graph API
-    if not os.path.exists(pages_file):
+def _bootstrap_pages(pages_file: str):
+    # Threads are coalesced by singleflight.do; the file lock makes other worker processes
+    # wait for this fetch and then find the file instead of fetching again.
+    with singleflight.file_lock(pages_file):
+        if os.path.exists(pages_file):
+            return
+
         print("📥 fb_pages.json not found. Fetching from Facebook Graph API...")
         user_access_token = os.getenv("ACCESS_TOKEN")
         if not user_access_token:
             raise Exception("❌ ACCESS_TOKEN not found in environment variables")
 
-        fb_url = f"https://graph.facebook.com/v21.0/me/accounts?access_token={user_access_token}"
-        response = requests.get(fb_url)
-        response.raise_for_status()
-
-        with open(pages_file, "w") as f:
-            f.write(response.text)
+        # Written to a temp file and renamed, so readers never see a partial file
+        page_store.sync_pages(user_access_token, pages_file)
 
         print("✅ fb_pages.json created successfully.")
 
-    # 3️⃣ Load fb_pages.json
-    with open(pages_file, "r") as f:
-        pages_data = json.load(f)["data"]
 
-    # 4️⃣ Find the matching page
-    page = next((p for p in pages_data if p["id"] == page_id), None)
+def get_page_access_token(school_id: str, pages_file="fb_pages.json"):
+    """
+    Fetch the Facebook Page ID from the configurations table, and get the matching access token
+    from fb_pages.json. If fb_pages.json doesn't exist, create it by calling Graph API once.
+    Both lookups are served from memory after the first call.
+    """
+    # 1️⃣ Get the facebook_page_id from configurations (bulk-resolved and cached)
+    page_id = get_page_id(school_id)
+
+    # 2️⃣ If fb_pages.json doesn't exist, fetch it from Facebook Graph API (once for all callers)
+    if not os.path.exists(pages_file):
+        singleflight.do(("bootstrap_pages", pages_file), lambda: _bootstrap_pages(pages_file))
+
+    # 3️⃣ Find the matching page (in-memory index, reloaded when fb_pages.json changes)
+    page = page_store.get_page(page_id, pages_file)
     if not page:
         raise Exception(f"Page ID {page_id} not found in {pages_file}")
 
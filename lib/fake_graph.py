@@ -0,0 +1,174 @@
+"""
+Minimal local stand-in for the Facebook Graph API, for running the uploader offline.
+
+    python -m lib.fake_graph --port 8099 --pages 120
+    FACEBOOK_API_URL=http://127.0.0.1:8099 python main.py --run_birthday_pipeline
+
+Supports /me/accounts (with cursor paging), /{id}, /{page}/feed, /{page}/photos and
+`batch` requests (including attached files). Every call is recorded and can be read back from /_calls.
+Tests start it with serve() and inject batch failures through `faults`.
+"""
+import json
+import threading
+import uuid
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qsl, urlencode
+
+_lock = threading.Lock()
+calls = []
+pages = []
+# Fault injection, by batch request number (1-based, counted since reset()): batches that fail
+# as a whole with a 500, and how many trailing operations of a batch are left unexecuted (null)
+faults = {"fail_batches": set(), "null_tail": {}, "batches": 0}
+
+
+def reset():
+    """
+    Forget recorded calls and injected faults.
+    """
+    with _lock:
+        calls.clear()
+        faults.update(fail_batches=set(), null_tail={}, batches=0)
+
+
+def make_pages(count: int) -> list:
+    return [
+        {"id": str(100000 + n), "name": f"Test School {n}", "access_token": f"PAGE_TOKEN_{n}", "category": "School"}
+        for n in range(count)
+    ]
+
+
+def _page_fields(page: dict, fields: str) -> dict:
+    if not fields:
+        return dict(page)
+    wanted = set(fields.split(","))
+    return {key: value for key, value in page.items() if key in wanted or key == "id"}
+
+
+def _dispatch(method: str, path: str, params: dict, files: dict, base_url: str):
+    # Returns (status code, JSON body) for one Graph call
+    with _lock:
+        calls.append({"method": method, "path": path, "params": {k: v for k, v in params.items() if k != "batch"}, "files": sorted(files)})
+    parts = [p for p in path.split("/") if p]
+
+    if method == "POST" and not parts and "batch" in params:
+        with _lock:
+            faults["batches"] += 1
+            number = faults["batches"]
+        if number in faults["fail_batches"]:
+            return 500, {"error": {"message": "An unknown error has occurred.", "type": "OAuthException", "code": 1}}
+        operations = json.loads(params["batch"])
+        executed = len(operations) - faults["null_tail"].get(number, 0)
+        results = []
+        for op in operations[:executed]:
+            op_url = urlparse("/" + op["relative_url"])
+            # Operations inherit the batch's access token
+            op_params = {"access_token": params["access_token"]} if "access_token" in params else {}
+            op_params.update(parse_qsl(op_url.query))
+            op_params.update(parse_qsl(op.get("body", "")))
+            op_files = {name: files[name] for name in op.get("attached_files", "").split(",") if name in files}
+            code, body = _dispatch(op.get("method", "GET"), op_url.path, op_params, op_files, base_url)
+            results.append({"code": code, "headers": [], "body": json.dumps(body)})
+        return 200, results + [None] * (len(operations) - executed)
+
+    if "access_token" not in params:
+        return 400, {"error": {"message": "An access token is required", "type": "OAuthException", "code": 104}}
+
+    if method == "GET" and parts == ["me", "accounts"]:
+        limit = int(params.get("limit", 25))
+        start = int(params.get("after", 0) or 0)
+        data = [_page_fields(p, params.get("fields")) for p in pages[start:start + limit]]
+        body = {"data": data, "paging": {"cursors": {"before": str(start), "after": str(start + len(data))}}}
+        if start + limit < len(pages):
+            body["paging"]["next"] = f"{base_url}/me/accounts?" + urlencode({**params, "after": start + limit})
+        return 200, body
+
+    if method == "GET" and len(parts) == 1:
+        page = next((p for p in pages if p["id"] == parts[0]), None)
+        if page is None:
+            return 404, {"error": {"message": f"Unknown object {parts[0]}", "type": "GraphMethodException", "code": 100}}
+        return 200, _page_fields(page, params.get("fields"))
+
+    if method == "POST" and len(parts) == 2 and parts[1] in ("feed", "photos"):
+        object_id = uuid.uuid4().hex[:15]
+        if parts[1] == "photos":
+            return 200, {"id": object_id, "post_id": f"{parts[0]}_{object_id}"}
+        return 200, {"id": f"{parts[0]}_{object_id}"}
+
+    return 404, {"error": {"message": f"Unsupported {method} {path}", "type": "GraphMethodException", "code": 100}}
+
+
+def _parse_body(headers, body: bytes):
+    # Form fields and uploaded files from an urlencoded or multipart body
+    content_type = headers.get("Content-Type", "")
+    if content_type.startswith("multipart/form-data"):
+        message = BytesParser(policy=HTTP).parsebytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+        params, files = {}, {}
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if part.get_filename():
+                files[name] = part.get_content()
+            else:
+                params[name] = part.get_content()
+        return params, files
+    return dict(parse_qsl(body.decode())), {}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def _respond(self, method: str):
+        url = urlparse(self.path)
+        if url.path == "/_calls":
+            code, body = 200, calls
+        else:
+            params = dict(parse_qsl(url.query))
+            files = {}
+            if method == "POST":
+                length = int(self.headers.get("Content-Length", 0))
+                form, files = _parse_body(self.headers, self.rfile.read(length))
+                params.update(form)
+            host = f"http://{self.headers.get('Host')}"
+            code, body = _dispatch(method, url.path, params, files, host)
+
+        payload = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        with _lock:
+            usage = min(100, len(calls) // 10)
+        self.send_header("X-App-Usage", json.dumps({"call_count": usage, "total_cputime": 0, "total_time": 0}))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        self._respond("GET")
+
+    def do_POST(self):
+        self._respond("POST")
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port: int = 8099, page_count: int = 5) -> ThreadingHTTPServer:
+    """
+    Start the fake server in a background thread and return it (call .shutdown() to stop).
+    """
+    pages[:] = make_pages(page_count)
+    server = ThreadingHTTPServer(("127.0.0.1", port), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--pages", type=int, default=5)
+    args = parser.parse_args()
+
+    pages[:] = make_pages(args.pages)
+    print(f"🧪 Fake Graph API on http://127.0.0.1:{args.port} with {args.pages} pages")
+    ThreadingHTTPServer(("127.0.0.1", args.port), _Handler).serve_forever()
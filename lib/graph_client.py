@@ -0,0 +1,111 @@
+import json
+import logging
+import os
+import time
+from typing import List, Dict, Any
+from urllib.parse import quote
+from lib import rate_limit
+from lib import http_client
+from lib import metrics
+
+logger = logging.getLogger(__name__)
+
+# Point this at lib.fake_graph (e.g. http://127.0.0.1:8099) to run without Facebook
+GRAPH_API_URL = os.getenv("FACEBOOK_API_URL", "https://graph.facebook.com/v23.0").rstrip("/")
+
+# Graph API accepts at most 50 operations per batch request
+BATCH_LIMIT = 50
+
+
+def graph_batch(operations: List[Dict[str, Any]], access_token: str, page_id: str = "app", retries: int = 1) -> List[Dict[str, Any]]:
+    """
+    Run many Graph API calls as `batch` requests of up to 50 operations each.
+    An operation is {"method": "GET"|"POST", "relative_url": "...", "body": {...}, "file": path}.
+    Returns one {"ok", "code", "body", "error"} per operation, in the same order.
+    Operations Facebook did not run (null entries, e.g. timeouts) are retried `retries` times.
+    A batch request that fails as a whole only fails its own operations; the results of the
+    other batches are kept. Those operations are not retried since some may have been run.
+    """
+    results: List[Dict[str, Any]] = [None] * len(operations)
+    pending = list(range(len(operations)))
+
+    for attempt in range(retries + 1):
+        skipped = []
+        for start in range(0, len(pending), BATCH_LIMIT):
+            chunk = pending[start:start + BATCH_LIMIT]
+            try:
+                responses = _send_batch([operations[i] for i in chunk], access_token, page_id)
+            except Exception as e:
+                logger.error(f"Graph batch request for {len(chunk)} operations failed: {e}")
+                for index in chunk:
+                    results[index] = {"ok": False, "code": None, "body": None, "error": str(e)}
+                continue
+            for index, response in zip(chunk, responses):
+                if response is None:
+                    skipped.append(index)
+                else:
+                    results[index] = _parse_item(response)
+        pending = skipped
+        if not pending:
+            break
+        logger.warning(f"Graph batch: {len(pending)} operations not executed, attempt {attempt + 1}")
+
+    for index in pending:
+        results[index] = {"ok": False, "code": None, "body": None, "error": "Operation was not executed by Graph API"}
+    return results
+
+
+def _send_batch(operations: List[Dict[str, Any]], access_token: str, page_id: str) -> List[Any]:
+    batch = []
+    files = {}
+    for n, op in enumerate(operations):
+        item = {"method": op.get("method", "GET"), "relative_url": op["relative_url"].lstrip("/")}
+        if op.get("body"):
+            item["body"] = "&".join(f"{key}={quote(str(value), safe='')}" for key, value in op["body"].items())
+        if op.get("file"):
+            name = f"file{n}"
+            item["attached_files"] = name
+            files[name] = (os.path.basename(op["file"]), open(op["file"], "rb"))
+        batch.append(item)
+
+    # Every operation counts against the rate limits, not the batch request itself
+    for _ in operations:
+        rate_limit.acquire(page_id)
+    started = time.perf_counter()
+    status = "error"
+    try:
+        response = http_client.post(
+            f"{GRAPH_API_URL}/",
+            data={"batch": json.dumps(batch), "access_token": access_token, "include_headers": "false"},
+            files=files or None
+        )
+        status = response.status_code
+    finally:
+        metrics.observe("graph_request_duration_seconds", time.perf_counter() - started, edge="batch", status=status)
+        for _, handle in files.values():
+            handle.close()
+
+    rate_limit.observe(page_id, response.headers)
+    if not response.ok:
+        metrics.inc("graph_errors_total", edge="batch", code=response.status_code)
+    response.raise_for_status()
+    responses = response.json()
+    # Missing trailing entries mean Facebook stopped processing the batch
+    return responses + [None] * (len(operations) - len(responses))
+
+
+def _parse_item(response: Dict[str, Any]) -> Dict[str, Any]:
+    code = response.get("code")
+    try:
+        body = json.loads(response.get("body") or "null")
+    except ValueError:
+        body = response.get("body")
+    ok = code is not None and 200 <= code < 300
+    error = None
+    if not ok:
+        error = body.get("error", {}).get("message") if isinstance(body, dict) else str(body)
+        metrics.inc("graph_errors_total", edge="batch_item", code=code)
+    return {"ok": ok, "code": code, "body": body, "error": error}
+
+
+__all__ = ["GRAPH_API_URL", "BATCH_LIMIT", "graph_batch"]
@@ -0,0 +1,95 @@
+import logging
+import os
+import threading
+import time
+from typing import Dict
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from lib import metrics
+from lib import deadline
+
+logger = logging.getLogger(__name__)
+
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "3.05"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+# Keep-alive connections kept per host
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))
+
+_lock = threading.Lock()
+# One pooled session per host (CDN, Graph API...), reused for every call
+_sessions: Dict[str, requests.Session] = {}
+
+
+def _retry() -> Retry:
+    # Read/status retries only for idempotent methods (GET, HEAD, PUT...); connection failures
+    # are retried for every method since nothing reached the server.
+    return Retry(
+        total=HTTP_RETRIES,
+        connect=HTTP_RETRIES,
+        read=HTTP_RETRIES,
+        status=HTTP_RETRIES,
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+        status_forcelist=(429, 500, 502, 503, 504),
+        backoff_factor=0.3,
+        backoff_jitter=0.3,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+
+
+def _session(host: str) -> requests.Session:
+    with _lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=_retry())
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[host] = session
+        return session
+
+
+def request(method: str, url: str, timeout=None, **kwargs) -> requests.Response:
+    """
+    requests.request through the shared per-host session, with default connect/read timeouts,
+    jittered retries for idempotent calls, and a latency sample per call in lib.metrics.
+    Timeouts are cut down to the remaining request deadline (lib.deadline), if one is set.
+    """
+    host = urlparse(url).netloc
+    if timeout is None:
+        timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    elif not isinstance(timeout, tuple):
+        timeout = (timeout, timeout)
+    timeout = tuple(deadline.clamp(t, f"{method} {host}") for t in timeout)
+
+    started = time.perf_counter()
+    status = "error"
+    try:
+        response = _session(host).request(
+            method,
+            url,
+            timeout=timeout,
+            **kwargs
+        )
+        status = str(response.status_code)
+        return response
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.observe("http_request_duration_seconds", elapsed, host=host, method=method, status=status)
+        logger.debug(f"{method} {host} -> {status} in {elapsed:.3f}s")
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return request("GET", url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    return request("POST", url, **kwargs)
+
+
+__all__ = ["request", "get", "post"]
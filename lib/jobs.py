@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import AsyncIterator, Callable, Dict, Any, List, Optional
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+# Finished jobs are kept for polling this many seconds
+JOB_TTL = int(os.getenv("JOB_TTL", "3600"))
+
+_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+_lock = threading.Lock()
+# (event loop, asyncio.Event) of every iter_events() stream, woken up by _emit
+_subscribers = set()
+_jobs: Dict[str, Dict[str, Any]] = {}
+
+
+def submit_job(meta: dict, prepare: Callable[[], List[Any]], work: Callable[[Any], dict], describe: Callable[[Any], str],
+               on_complete: Callable[[List[Dict[str, Any]]], Any] = None) -> str:
+    """
+    Create a job and run it in the background worker pool. Returns the job id immediately.
+    `prepare` loads the items (e.g. today's students), then `work(item, stage)` is run for each
+    item on the shared workers. `describe` gives the label shown in the per-item progress.
+    `stage(name)` is a context manager the work function wraps each step in (download, render,
+    upload...) so its start, end and duration are recorded and emitted as events.
+    `on_complete(items)` runs once every item has finished; its return value is stored as job["output"].
+    """
+    _prune()
+    job_id = uuid.uuid4().hex
+    with _lock:
+        _jobs[job_id] = {
+            "id": job_id,
+            **meta,
+            "status": "queued",
+            "created_at": time.time(),
+            "finished_at": None,
+            "total": None,
+            "completed": 0,
+            "failed": 0,
+            "items": [],
+            "error": None,
+            "output": None,
+            "events": [],
+        }
+    _executor.submit(_prepare, job_id, prepare, work, describe, on_complete)
+    return job_id
+
+
+def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Snapshot of a job's status and per-item progress, or None if unknown/expired.
+    """
+    with _lock:
+        job = _jobs.get(job_id)
+        if job is None:
+            return None
+        snapshot = {key: value for key, value in job.items() if key != "events"}
+        snapshot["items"] = [dict(item, stages=dict(item["stages"])) for item in job["items"]]
+        return snapshot
+
+
+async def iter_events(job_id: str, start: int = 0, heartbeat: float = 15.0) -> AsyncIterator[Optional[Dict[str, Any]]]:
+    """
+    Yield the job's events from index `start` onwards, waiting (on the event loop, without
+    holding a thread) until new ones arrive. Yields None every `heartbeat` seconds without
+    events, and stops once the job has finished.
+    """
+    wakeup = asyncio.Event()
+    subscriber = (asyncio.get_running_loop(), wakeup)
+    with _lock:
+        _subscribers.add(subscriber)
+    index = start
+    try:
+        while True:
+            # Cleared before looking, so an event emitted right after still wakes us up
+            wakeup.clear()
+            with _lock:
+                job = _jobs.get(job_id)
+                if job is None:
+                    return
+                pending = job["events"][index:]
+                done = job["finished_at"] is not None
+            for event in pending:
+                yield event
+            index += len(pending)
+            if done:
+                return
+            if not pending:
+                try:
+                    await asyncio.wait_for(wakeup.wait(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield None
+    finally:
+        with _lock:
+            _subscribers.discard(subscriber)
+
+
+def _emit(job: Dict[str, Any], event_type: str, **data):
+    # Caller must hold _lock
+    job["events"].append({"id": len(job["events"]), "type": event_type, "time": time.time(), **data})
+    for loop, wakeup in _subscribers:
+        try:
+            loop.call_soon_threadsafe(wakeup.set)
+        except RuntimeError:  # loop already closed
+            pass
+
+
+def _prepare(job_id: str, prepare, work, describe, on_complete):
+    job = _jobs[job_id]
+    try:
+        items = prepare()
+    except Exception as e:
+        logger.error(f"Job {job_id} failed to start: {e}")
+        _finish(job_id, "failed", str(e))
+        return
+
+    with _lock:
+        job["status"] = "running"
+        job["total"] = len(items)
+        job["items"] = [{"item": describe(item), "status": "pending", "stages": {}} for item in items]
+        _emit(job, "job_started", total=len(items))
+    if not items:
+        _finish(job_id, "done")
+        return
+
+    for index, item in enumerate(items):
+        _executor.submit(_run_item, job_id, index, item, work, on_complete)
+
+
+def _run_item(job_id: str, index: int, item, work, on_complete):
+    job = _jobs[job_id]
+    entry = job["items"][index]
+    with _lock:
+        entry["status"] = "running"
+
+    @contextmanager
+    def stage(name: str):
+        with _lock:
+            entry["stage"] = name
+            _emit(job, "stage_started", index=index, item=entry["item"], stage=name)
+        stage_started = time.perf_counter()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            duration = round(time.perf_counter() - stage_started, 3)
+            with _lock:
+                entry["stages"][name] = duration
+                _emit(job, "stage_finished", index=index, item=entry["item"], stage=name, duration=duration, ok=ok)
+
+    started = time.perf_counter()
+    try:
+        result = work(item, stage)
+        with _lock:
+            entry.update(status="done", result=result)
+            job["completed"] += 1
+    except Exception as e:
+        logger.error(f"Job {job_id} item {entry['item']} failed: {e}")
+        with _lock:
+            entry.update(status="failed", error=str(e))
+            job["failed"] += 1
+    with _lock:
+        entry["duration"] = round(time.perf_counter() - started, 3)
+        entry.pop("stage", None)
+        _emit(job, "item_finished", index=index, item=entry["item"], status=entry["status"],
+              duration=entry["duration"], error=entry.get("error"))
+        finished = job["completed"] + job["failed"] == job["total"]
+    if finished:
+        if on_complete:
+            try:
+                output = on_complete(get_job(job_id)["items"])
+                with _lock:
+                    job["output"] = output
+            except Exception as e:
+                logger.error(f"Job {job_id} completion failed: {e}")
+                _finish(job_id, "failed", str(e))
+                return
+        _finish(job_id, "done")
+
+
+def _finish(job_id: str, status: str, error: str = None):
+    with _lock:
+        job = _jobs[job_id]
+        job["status"] = status
+        job["error"] = error
+        job["finished_at"] = time.time()
+        _emit(job, "job_finished", status=status, completed=job["completed"], failed=job["failed"], error=error)
+
+
+def _prune():
+    # Forget finished jobs older than JOB_TTL
+    now = time.time()
+    with _lock:
+        expired = [job_id for job_id, job in _jobs.items() if job["finished_at"] and now - job["finished_at"] > JOB_TTL]
+        for job_id in expired:
+            del _jobs[job_id]
+
+
+__all__ = ["submit_job", "get_job", "iter_events"]
@@ -0,0 +1,82 @@
+import json
+import os
+import re
+import time
+import uuid
+from datetime import date
+from glob import glob
+from typing import List, Dict, Any
+from lib import render_cache
+from lib.storage import atomic_write, check_school_id
+
+MANIFEST_DIR = os.getenv("MANIFEST_DIR", "manifests")
+
+# What new_run_id() produces (and nothing that could leave the manifest folder)
+_RUN_ID = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+def new_run_id() -> str:
+    return time.strftime("%H%M%S") + "-" + uuid.uuid4().hex[:8]
+
+
+def manifest_entry(school_id: str, student: dict, result: dict, day: date = None) -> Dict[str, Any]:
+    """
+    Describe one rendered poster: who it is for, where it is, its content hash and size.
+    """
+    return {
+        "school_id": school_id,
+        "date": (day or date.today()).isoformat(),
+        "student_id": student.get("_uid"),
+        "student": student["full_name"],
+        "file": result["file"],
+        "hash": render_cache.file_hash(result["file"]),
+        "width": result["width"],
+        "height": result["height"],
+        "variants": result.get("variants", {}),
+    }
+
+
+def manifest_path(school_id: str, run_id: str, day: date = None) -> str:
+    """
+    <MANIFEST_DIR>/<school_id>/<date>/<run_id>.json; raises ValueError for an id that is not
+    a plain identifier, so callers can pass ids straight from a request.
+    """
+    if not isinstance(run_id, str) or not _RUN_ID.match(run_id):
+        raise ValueError(f"Invalid run_id: {run_id!r}")
+    day = day or date.today()
+    return os.path.join(MANIFEST_DIR, check_school_id(school_id), day.isoformat(), f"{run_id}.json")
+
+
+def write_manifest(school_id: str, run_id: str, entries: List[Dict[str, Any]], day: date = None) -> str:
+    """
+    Write the run's manifest to <MANIFEST_DIR>/<school_id>/<date>/<run_id>.json and return its path.
+    Written atomically, so readers never see a partial manifest.
+    """
+    day = day or date.today()
+    path = manifest_path(school_id, run_id, day)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with atomic_write(path, "w") as f:
+        json.dump({"school_id": school_id, "date": day.isoformat(), "run_id": run_id, "entries": entries}, f, indent=2)
+    return path
+
+
+def read_manifest(path: str) -> Dict[str, Any]:
+    with open(path) as f:
+        return json.load(f)
+
+
+def todays_entries(school_id: str, day: date = None) -> List[Dict[str, Any]]:
+    """
+    All posters rendered for the school on `day`, from that day's manifests only.
+    When a student was rendered in several runs the latest run wins.
+    """
+    day = day or date.today()
+    paths = sorted(glob(os.path.join(MANIFEST_DIR, check_school_id(school_id), day.isoformat(), "*.json")), key=os.path.getmtime)
+    entries = {}
+    for path in paths:
+        for entry in read_manifest(path)["entries"]:
+            entries[entry["student_id"] or entry["file"]] = entry
+    return list(entries.values())
+
+
+__all__ = ["new_run_id", "manifest_entry", "manifest_path", "write_manifest", "read_manifest", "todays_entries"]
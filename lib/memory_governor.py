@@ -0,0 +1,91 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from PIL import Image
+
+from lib import deadline
+from lib import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def _default_budget() -> int:
+    # Half of the machine's RAM, leaving the rest to Python, Tesseract and the OS
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 2
+    except (ValueError, OSError, AttributeError):  # not available on Windows
+        return 1024 * 1024 * 1024
+
+
+# Total estimated bytes all concurrent renders may hold (RENDER_MEMORY_BUDGET_MB overrides)
+RENDER_MEMORY_BUDGET = int(float(os.getenv("RENDER_MEMORY_BUDGET_MB", "0")) * 1024 * 1024) or _default_budget()
+
+# Bytes held per template pixel by one replace_circle() run, at its peak:
+# OpenCV BGR (3) + gray (1) + blurred (1) + HoughCircles gradients/accumulator (~8)
+# + BGR->RGB (3) + PIL RGB (3) + PIL RGBA (4) + NumPy RGBA/RGB/RGB for OCR (4+3+3)
+# + copy to draw on (4) + Tesseract's own copy (~3)
+BYTES_PER_TEMPLATE_PIXEL = 40
+# Decoded student photo (3) + its RGBA conversion (4), before it is shrunk to the circle
+BYTES_PER_PHOTO_PIXEL = 7
+
+_cond = threading.Condition()
+_in_use = 0
+_active = 0
+
+
+def estimate_render_bytes(poster_path: str, photo_path: str) -> int:
+    """
+    Estimated peak memory of rendering `photo_path` onto `poster_path`, from the image headers
+    (nothing is decoded).
+    """
+    estimate = 0
+    for path, per_pixel in ((poster_path, BYTES_PER_TEMPLATE_PIXEL), (photo_path, BYTES_PER_PHOTO_PIXEL)):
+        try:
+            with Image.open(path) as img:
+                width, height = img.size
+        except (OSError, ValueError):
+            # Unreadable image: the render fails fast on it anyway
+            continue
+        estimate += width * height * per_pixel
+    return estimate
+
+
+def in_use() -> int:
+    return _in_use
+
+
+@contextmanager
+def reserve(nbytes: int, stage: str = "render"):
+    """
+    Hold `nbytes` of the render memory budget for the block, waiting while admitting it would
+    go over RENDER_MEMORY_BUDGET. A render larger than the whole budget still runs, but alone.
+    Waiting stops with DeadlineExceeded/Cancelled when the current request deadline says so.
+    """
+    global _in_use, _active
+    started = time.monotonic()
+    with _cond:
+        while _active and _in_use + nbytes > RENDER_MEMORY_BUDGET:
+            deadline.check(f"{stage} (waiting for memory)")
+            left = deadline.remaining()
+            # Wake up now and then to notice cancellation
+            _cond.wait(timeout=1.0 if left is None else min(1.0, max(left, 0.01)))
+        _in_use += nbytes
+        _active += 1
+    waited = time.monotonic() - started
+    metrics.observe("render_memory_wait_seconds", waited)
+    if waited > 1:
+        logger.info(f"{stage}: waited {waited:.1f}s for {nbytes / 2**20:.0f} MB of render memory")
+
+    try:
+        yield
+    finally:
+        with _cond:
+            _in_use -= nbytes
+            _active -= 1
+            _cond.notify_all()
+
+
+__all__ = ["RENDER_MEMORY_BUDGET", "BYTES_PER_TEMPLATE_PIXEL", "BYTES_PER_PHOTO_PIXEL", "estimate_render_bytes", "in_use", "reserve"]
@@ -0,0 +1,113 @@
+import threading
+from typing import Dict, Tuple
+
+# Upper bounds (seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Upper bounds (bytes) for payload size histograms: 1 KB .. 64 MB
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(9))
+
+_lock = threading.Lock()
+# (name, labels) -> {"buckets": tuple, "counts": [...], "sum": float, "count": int}
+_histograms: Dict[Tuple[str, tuple], dict] = {}
+# (name, labels) -> value
+_counters: Dict[Tuple[str, tuple], float] = {}
+# (name, labels) -> value
+_gauges: Dict[Tuple[str, tuple], float] = {}
+
+
+def _key(name: str, labels: dict) -> Tuple[str, tuple]:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def observe(name: str, value: float, buckets: tuple = DEFAULT_BUCKETS, **labels):
+    """
+    Record one sample (usually a duration in seconds) in a histogram.
+    """
+    key = _key(name, labels)
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(hist["buckets"]):
+            if value <= bound:
+                hist["counts"][i] += 1
+                break
+        hist["sum"] += value
+        hist["count"] += 1
+
+
+def inc(name: str, amount: float = 1, **labels):
+    """
+    Increase a counter.
+    """
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def set_gauge(name: str, value: float, **labels):
+    """
+    Set a gauge to its current value (e.g. queue length, memory in use).
+    """
+    key = _key(name, labels)
+    with _lock:
+        _gauges[key] = value
+
+
+def snapshot() -> dict:
+    """
+    Copy of all metrics: {"histograms": {...}, "counters": {...}, "gauges": {...}}.
+    """
+    with _lock:
+        return {
+            "histograms": {key: dict(hist, counts=list(hist["counts"])) for key, hist in _histograms.items()},
+            "counters": dict(_counters),
+            "gauges": dict(_gauges),
+        }
+
+
+def _labels(labels: tuple, extra: tuple = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def render_prometheus() -> str:
+    """
+    All metrics in the Prometheus text exposition format (version 0.0.4).
+    Counters get the conventional `_total` suffix if their name lacks it.
+    """
+    data = snapshot()
+    lines = []
+    typed = set()
+
+    def type_line(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in sorted(data["counters"].items()):
+        name = name if name.endswith("_total") else f"{name}_total"
+        type_line(name, "counter")
+        lines.append(f"{name}{_labels(labels)} {value}")
+
+    for (name, labels), value in sorted(data["gauges"].items()):
+        type_line(name, "gauge")
+        lines.append(f"{name}{_labels(labels)} {value}")
+
+    for (name, labels), hist in sorted(data["histograms"].items()):
+        type_line(name, "histogram")
+        cumulative = 0
+        for bound, count in zip(hist["buckets"], hist["counts"]):
+            cumulative += count
+            lines.append(f"{name}_bucket{_labels(labels, (('le', repr(float(bound))),))} {cumulative}")
+        lines.append(f"{name}_bucket{_labels(labels, (('le', '+Inf'),))} {hist['count']}")
+        lines.append(f"{name}_sum{_labels(labels)} {hist['sum']}")
+        lines.append(f"{name}_count{_labels(labels)} {hist['count']}")
+
+    return "\n".join(lines) + "\n"
+
+
+__all__ = ["DEFAULT_BUCKETS", "BYTES_BUCKETS", "observe", "inc", "set_gauge", "snapshot", "render_prometheus"]
@@ -0,0 +1,191 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional
+from lib.graph_client import GRAPH_API_URL
+from lib.storage import atomic_write
+from lib import http_client
+
+logger = logging.getLogger(__name__)
+
+PAGE_STORE_DB = os.getenv("PAGE_STORE_DB", "page_store.sqlite3")
+# fb_pages.json is checked for changes at most this often (seconds)
+PAGE_STORE_CHECK_INTERVAL = float(os.getenv("PAGE_STORE_CHECK_INTERVAL", "5"))
+# Only the fields the uploader needs, and as many pages per call as Graph allows
+PAGE_SYNC_FIELDS = "id,name,access_token,category"
+PAGE_SYNC_LIMIT = int(os.getenv("PAGE_SYNC_LIMIT", "100"))
+
+_lock = threading.RLock()
+_conn: Optional[sqlite3.Connection] = None
+# page_id -> page dict and school_id -> page_id, loaded once and kept in memory
+_pages: Dict[str, Dict[str, Any]] = {}
+_schools: Dict[str, str] = {}
+_source = {"file": None, "mtime": None, "checked": 0.0}
+
+
+def _connection() -> sqlite3.Connection:
+    # Caller must hold _lock
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(PAGE_STORE_DB, check_same_thread=False)
+        _conn.executescript("""
+            CREATE TABLE IF NOT EXISTS pages (
+                page_id TEXT PRIMARY KEY,
+                name TEXT,
+                access_token TEXT NOT NULL,
+                data TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS school_pages (
+                school_id TEXT PRIMARY KEY,
+                page_id TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+    return _conn
+
+
+def _load(pages_file: str):
+    # Caller must hold _lock. Load from SQLite when it already mirrors this version of the file,
+    # otherwise parse the JSON once and rewrite the SQLite copy.
+    conn = _connection()
+    mtime = os.path.getmtime(pages_file) if os.path.exists(pages_file) else None
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (f"mtime:{pages_file}",)).fetchone()
+
+    if mtime is not None and (row is None or float(row[0]) != mtime):
+        with open(pages_file, "r") as f:
+            pages_data = json.load(f)["data"]
+        conn.execute("DELETE FROM pages")
+        conn.executemany(
+            "INSERT INTO pages (page_id, name, access_token, data) VALUES (?, ?, ?, ?)",
+            [(str(p["id"]), p.get("name"), p["access_token"], json.dumps(p)) for p in pages_data]
+        )
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (f"mtime:{pages_file}", str(mtime)))
+        conn.commit()
+        logger.info(f"Page store loaded {len(pages_data)} pages from {pages_file}")
+
+    _pages.clear()
+    for page_id, data in conn.execute("SELECT page_id, data FROM pages"):
+        _pages[page_id] = json.loads(data)
+    _schools.clear()
+    for school_id, page_id in conn.execute("SELECT school_id, page_id FROM school_pages"):
+        _schools[school_id] = page_id
+    _source.update(file=pages_file, mtime=mtime, checked=time.monotonic())
+
+
+def _ensure_fresh(pages_file: str):
+    # Caller must hold _lock
+    now = time.monotonic()
+    if _source["file"] != pages_file:
+        _load(pages_file)
+    elif now - _source["checked"] >= PAGE_STORE_CHECK_INTERVAL:
+        _source["checked"] = now
+        mtime = os.path.getmtime(pages_file) if os.path.exists(pages_file) else None
+        if mtime != _source["mtime"]:
+            _load(pages_file)
+
+
+def get_page(page_id: str, pages_file: str = "fb_pages.json") -> Optional[Dict[str, Any]]:
+    """
+    Page (id, name, access_token...) by page id; a dict lookup once warm.
+    """
+    with _lock:
+        _ensure_fresh(pages_file)
+        return _pages.get(str(page_id))
+
+
+def get_school_page_id(school_id: str, pages_file: str = "fb_pages.json") -> Optional[str]:
+    with _lock:
+        _ensure_fresh(pages_file)
+        return _schools.get(school_id)
+
+
+def set_school_page_id(school_id: str, page_id: str):
+    """
+    Remember which page a school posts to (from its facebook_page_id configuration).
+    """
+    with _lock:
+        _schools[school_id] = str(page_id)
+        conn = _connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO school_pages (school_id, page_id, updated_at) VALUES (?, ?, ?)",
+            (school_id, str(page_id), time.time())
+        )
+        conn.commit()
+
+
+def _fetch_accounts(url: str, params: dict = None) -> dict:
+    response = http_client.get(url, params=params)
+    response.raise_for_status()
+    return response.json()
+
+
+def sync_pages(user_access_token: str, pages_file: str = "fb_pages.json") -> Dict[str, Any]:
+    """
+    Fetch every page the user manages from /me/accounts, following `paging.next` cursors.
+    Each page of results is merged into the store as it arrives while the next one is already
+    being fetched. Pages no longer returned are removed, and fb_pages.json is rewritten.
+    Returns a diff report {"added", "removed", "updated", "total"} of page ids.
+    """
+    with _lock:
+        _ensure_fresh(pages_file)
+        previous = {page_id: page["access_token"] for page_id, page in _pages.items()}
+
+    seen = {}
+    pages_data = []
+    with ThreadPoolExecutor(max_workers=1) as prefetch:
+        future = prefetch.submit(_fetch_accounts, f"{GRAPH_API_URL}/me/accounts", {
+            "fields": PAGE_SYNC_FIELDS,
+            "limit": PAGE_SYNC_LIMIT,
+            "access_token": user_access_token,
+        })
+        while future is not None:
+            body = future.result()
+            next_url = body.get("paging", {}).get("next")
+            # Start fetching the next cursor before merging this batch
+            future = prefetch.submit(_fetch_accounts, next_url) if next_url else None
+
+            batch = [dict(page, id=str(page["id"])) for page in body.get("data", [])]
+            with _lock:
+                conn = _connection()
+                conn.executemany(
+                    "INSERT OR REPLACE INTO pages (page_id, name, access_token, data) VALUES (?, ?, ?, ?)",
+                    [(p["id"], p.get("name"), p["access_token"], json.dumps(p)) for p in batch]
+                )
+                conn.commit()
+                for page in batch:
+                    _pages[page["id"]] = page
+            for page in batch:
+                seen[page["id"]] = page["access_token"]
+            pages_data.extend(batch)
+
+    removed = sorted(set(previous) - set(seen))
+    with atomic_write(pages_file, "w") as f:
+        json.dump({"data": pages_data}, f, indent=2)
+    with _lock:
+        conn = _connection()
+        conn.executemany("DELETE FROM pages WHERE page_id = ?", [(page_id,) for page_id in removed])
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (f"mtime:{pages_file}", str(os.path.getmtime(pages_file))))
+        conn.commit()
+        for page_id in removed:
+            _pages.pop(page_id, None)
+        _source.update(file=pages_file, mtime=os.path.getmtime(pages_file), checked=time.monotonic())
+
+    report = {
+        "added": sorted(set(seen) - set(previous)),
+        "removed": removed,
+        "updated": sorted(page_id for page_id in seen if page_id in previous and previous[page_id] != seen[page_id]),
+        "total": len(seen),
+    }
+    logger.info(f"Page sync: {len(report['added'])} added, {len(report['removed'])} removed, {len(report['updated'])} updated, {report['total']} total")
+    return report
+
+
+__all__ = ["get_page", "get_school_page_id", "set_school_page_id", "sync_pages"]
@@ -0,0 +1,82 @@
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "8"))
+
+# Marks the end of a stage's input; each worker that sees it passes it on to its siblings
+_DONE = object()
+
+
+def run_pipeline(items: Iterable[Any], stages: List[Tuple[str, Callable[[Any], Any], int]], queue_size: int = PIPELINE_QUEUE_SIZE) -> List[Dict[str, Any]]:
+    """
+    Run every item through `stages` = [(name, fn, workers), ...] with all stages working at the same time.
+    Stages are connected by bounded queues (`queue_size`), so a fast stage can only run a few items
+    ahead of a slow one, and each stage has its own number of worker threads.
+    The output of one stage's fn is the input of the next one. An item whose stage raises skips the
+    remaining stages. Returns one {"item", "value", "error", "failed_stage", "timings"} dict per item,
+    in input order.
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    results: List[Dict[str, Any]] = []
+    results_lock = threading.Lock()
+
+    def worker(stage_index: int):
+        name, fn, _ = stages[stage_index]
+        inbox = queues[stage_index]
+        outbox = queues[stage_index + 1] if stage_index + 1 < len(stages) else None
+        while True:
+            envelope = inbox.get()
+            if envelope is _DONE:
+                inbox.put(_DONE)
+                return
+            if envelope["error"] is None:
+                started = time.perf_counter()
+                try:
+                    envelope["value"] = fn(envelope["value"])
+                except Exception as e:
+                    logger.error(f"Stage {name} failed for item {envelope['index']}: {e}")
+                    envelope["error"] = str(e)
+                    envelope["failed_stage"] = name
+                envelope["timings"][name] = round(time.perf_counter() - started, 3)
+            if outbox is not None:
+                outbox.put(envelope)
+            else:
+                with results_lock:
+                    results.append(envelope)
+
+    threads = []
+    for stage_index, (name, _, workers) in enumerate(stages):
+        stage_threads = [
+            threading.Thread(target=worker, args=(stage_index,), name=f"pipeline-{name}-{n}", daemon=True)
+            for n in range(max(1, workers))
+        ]
+        for thread in stage_threads:
+            thread.start()
+        threads.append(stage_threads)
+
+    started = time.perf_counter()
+    count = 0
+    for index, item in enumerate(items):
+        queues[0].put({"index": index, "item": item, "value": item, "error": None, "failed_stage": None, "timings": {}})
+        count += 1
+    queues[0].put(_DONE)
+
+    # Once every worker of a stage has exited, nothing more can reach the next stage
+    for stage_index, stage_threads in enumerate(threads):
+        for thread in stage_threads:
+            thread.join()
+        if stage_index + 1 < len(stages):
+            queues[stage_index + 1].put(_DONE)
+
+    logger.info(f"Pipeline finished {count} items in {time.perf_counter() - started:.2f}s")
+    results.sort(key=lambda envelope: envelope["index"])
+    return results
+
+
+__all__ = ["run_pipeline"]
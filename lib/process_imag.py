@@ -1,11 +1,27 @@
 import cv2
-import requests
+import io
+import json
+import logging
 import pytesseract
 import numpy as np
 import os
+import time
 from PIL import Image, ImageDraw, ImageFont
-from glob import glob
 from lib.facebook_utils import get_page_access_token
+from lib.variants import generate_variants
+from lib import render_cache
+from lib import rate_limit
+from lib import http_client
+from lib import deadline
+from lib import memory_governor
+from lib import metrics
+from lib.graph_client import GRAPH_API_URL, graph_batch
+from lib import upload_ledger
+from lib.manifest import read_manifest, todays_entries
+from lib.storage import atomic_write
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
 
 
 def add_name(poster_path:str, output_path:str, old_text:str, new_text:str) -> dict :
@@ -60,12 +76,80 @@ def capitalize_name(full_name: str) -> str:
         # For more than two words, capitalize each word
         return ' '.join(word.capitalize() for word in words)
 
-def replace_circle(img_path: str,  poster_path: str, output_folder: str, old_text:str, new_text:str ) -> dict:
+# Upper bound for one Tesseract run when a request deadline is set (seconds)
+OCR_TIMEOUT = float(os.getenv("OCR_TIMEOUT", "60"))
+
+
+class _StageClock:
+    """
+    Lap timer for the stages of one render: lap(stage) charges the time since the previous
+    lap to `stage` (repeated stages add up) and records it in lib.metrics.
+    """
+    def __init__(self):
+        self.started = self._last = time.perf_counter()
+        self.timings = {}
+
+    def lap(self, stage: str):
+        now = time.perf_counter()
+        elapsed = now - self._last
+        self._last = now
+        self.timings[stage] = round(self.timings.get(stage, 0) + elapsed, 4)
+        metrics.observe("render_stage_duration_seconds", elapsed, stage=stage)
+
+    def total(self) -> float:
+        return round(time.perf_counter() - self.started, 4)
+
+
+def replace_circle(img_path: str,  poster_path: str, output_folder: str, old_text:str, new_text:str, variants: list = None, use_cache: bool = True, cache_key: str = None) -> dict:
     """
       Replace a detected circle in base image with an overlay image (circular cropped).
+      If `variants` is given, the composite is also downscaled into every configured size/format.
+      Identical inputs (same template, photo, texts and variants) are served from the render cache.
+      A caller that already looked its `cache_key` up (and missed) passes it to skip a second lookup.
     """
+    base_name = os.path.splitext(os.path.basename(img_path))[0]
+    clock = _StageClock()
+
+    # Return the previously encoded files if nothing changed
+    if not use_cache:
+        cache_key = None
+    elif cache_key is None:
+        cache_key = render_cache.render_key(
+            render_cache.file_hash(poster_path),
+            render_cache.file_hash(img_path),
+            old_text,
+            new_text,
+            variants
+        )
+        entry = render_cache.get(cache_key)
+        if entry:
+            print(f"Render cache hit for {base_name}")
+            try:
+                restored = render_cache.restore(entry, output_folder, base_name)
+                with Image.open(restored["file"]) as cached_img:
+                    width, height = cached_img.size
+            except OSError as e:
+                # Evicted by another thread between get() and restore(): render it again
+                print(f"⚠ Render cache entry for {base_name} is gone ({e}), rendering")
+            else:
+                clock.lap("cache_restore")
+                metrics.observe("render_duration_seconds", clock.total(), cached="true")
+                return {"Output": output_folder, "status": "true", **restored, "width": width, "height": height, "cache_key": cache_key, "cached": True, "timings": clock.timings}
+
+    # Hold the estimated memory of this render; waits while concurrent renders use up the budget
+    with memory_governor.reserve(memory_governor.estimate_render_bytes(poster_path, img_path), f"render {base_name}"):
+        clock.lap("memory_wait")
+        result = _render_poster(img_path, poster_path, output_folder, old_text, new_text, variants, base_name, cache_key, clock)
+    metrics.observe("render_duration_seconds", clock.total(), cached="false")
+    logger.debug(f"Rendered {base_name} in {clock.total()}s: {clock.timings}")
+    return result
+
+
+def _render_poster(img_path: str, poster_path: str, output_folder: str, old_text: str, new_text: str, variants: list, base_name: str, cache_key: str, clock: _StageClock) -> dict:
     # Detect circle in template using OpenCV
+    deadline.check("render")
     template_cv = cv2.imread(poster_path)
+    clock.lap("decode")
     grey = cv2.cvtColor(template_cv, cv2.COLOR_BGR2GRAY)
     gray_blur = cv2.medianBlur(grey, 5)
 
@@ -83,10 +167,12 @@ def replace_circle(img_path: str,  poster_path: str, output_folder: str, old_tex
     circles = np.uint16(np.around(circles))
     x_center, y_center, radius = circles[0][0]
     print(f"Circle detected: center=({x_center},{y_center}), radius={radius}")
+    clock.lap("detect")
 
     # convert cv2 image -> PIL
     template = Image.fromarray(cv2.cvtColor(template_cv, cv2.COLOR_BGR2RGB)).convert("RGBA")
     subject = Image.open(img_path).convert("RGBA")
+    clock.lap("decode")
 
     # Diameter of circle
     circle_diameter = radius * 2
@@ -108,12 +194,21 @@ def replace_circle(img_path: str,  poster_path: str, output_folder: str, old_tex
     top_left_y = y_center - radius
 
     template.paste(subject_circle, (top_left_x, top_left_y), subject_circle)
+    clock.lap("composite")
 
     # --- Step 4: OCR text replacement ---
     # Convert to cv2 again for OCR
     template_cv = cv2.cvtColor(np.array(template), cv2.COLOR_RGBA2RGB)
     rgb = cv2.cvtColor(template_cv, cv2.COLOR_BGR2RGB)
-    results = pytesseract.image_to_data(rgb, output_type=pytesseract.Output.DICT)
+    # Tesseract is killed if it runs past the request deadline (0 = no timeout)
+    ocr_timeout = deadline.clamp(OCR_TIMEOUT, "OCR") if deadline.remaining() is not None else 0
+    try:
+        results = pytesseract.image_to_data(rgb, output_type=pytesseract.Output.DICT, timeout=ocr_timeout)
+    except RuntimeError as e:
+        if ocr_timeout:
+            raise deadline.DeadlineExceeded(f"OCR did not finish within the deadline: {e}")
+        raise
+    clock.lap("ocr")
 
     pil_img = template.copy()
     draw = ImageDraw.Draw(pil_img)
@@ -158,29 +253,217 @@ def replace_circle(img_path: str,  poster_path: str, output_folder: str, old_tex
 
     if not found:
         print(f"⚠ Could not find '{old_text}' in the image.")
+    clock.lap("text_draw")
 
     # --- Step 5: Save and cleanup ---
     print(f"Saving output to {output_folder}")
 
+    # Encode in memory first so PNG compression and disk writes are timed apart
+    encoded = io.BytesIO()
+    pil_img.save(encoded, format="PNG")
+    clock.lap("encode")
+
     # Get just the filename without extension
-    file_name = os.path.splitext(os.path.basename(img_path))[0] + ".png"
-    pil_img.save(os.path.join(output_folder, file_name), format="PNG")
+    file_name = base_name + ".png"
+    with atomic_write(os.path.join(output_folder, file_name)) as f:
+        f.write(encoded.getbuffer())
+    clock.lap("write")
+
+    # Downscale the same composite into the configured sizes (feed, story, thumbnail...)
+    variant_paths = generate_variants(pil_img, variants, output_folder, base_name)
+    clock.lap("variants")
+
+    if cache_key:
+        render_cache.put(cache_key, os.path.join(output_folder, file_name), variant_paths)
+        clock.lap("write")
 
     # Removing the file after processing
     #os.remove(poster_path)
     # os.remove(img_path)
 
-    return {"Output": output_folder, "status": "true"}
+    return {"Output": output_folder, "status": "true", "file": os.path.join(output_folder, file_name), "variants": variant_paths, "width": pil_img.width, "height": pil_img.height, "cache_key": cache_key, "cached": False, "timings": clock.timings}
 
 import os
-import requests
-from glob import glob
 
-def post_on_facebook(output_folder="outputs", school_id="testschool"):
+BIRTHDAY_MESSAGE = "🎂 Happy Birthday from Our Whole School Family! 🎉"
+
+
+def _graph_post(page_id: str, edge: str, data: dict, image_path: str = None) -> dict:
+    # POST to /{page_id}/{edge} through the rate limiter; raises with the response body on failure
+    fb_url = f"{GRAPH_API_URL}/{page_id}/{edge}"
+    deadline.check(f"upload to {page_id}/{edge}")
+
+    # Facebook API requires multipart/form-data for direct image uploads
+    img_file = open(image_path, "rb") if image_path else None
+    try:
+        files = {"source": img_file} if img_file else None
+        # Wait for the app/page rate limiter before calling Graph API
+        rate_limit.acquire(page_id)
+        started = time.perf_counter()
+        status = "error"
+        try:
+            response = http_client.post(fb_url, files=files, data=data)
+            status = response.status_code
+        finally:
+            metrics.observe("graph_request_duration_seconds", time.perf_counter() - started, edge=edge, status=status)
+    finally:
+        if img_file:
+            img_file.close()
+
+    rate_limit.observe(page_id, response.headers)
+    try:
+        response.raise_for_status()
+    except Exception as e:
+        try:
+            error_code = response.json().get("error", {}).get("code")
+        except ValueError:
+            error_code = None
+        metrics.inc("graph_errors_total", edge=edge, code=error_code or response.status_code)
+        if response.status_code == 429 or error_code in rate_limit.THROTTLE_ERROR_CODES:
+            rate_limit.throttled(page_id, response.headers, error_code)
+        raise Exception(f"{e} Response: {response.text}")
+    return response.json()
+
+
+def upload_poster(page_id: str, access_token: str, image_path: str, message: str = BIRTHDAY_MESSAGE) -> dict:
+    """
+    Upload a single poster to the Facebook Page and return the Graph API response.
+    Raises if the upload fails.
+    """
+    print(f"📤 Uploading {os.path.basename(image_path)} to Facebook Page {page_id}...")
+    return _graph_post(page_id, "feed", {"caption": message, "access_token": access_token}, image_path)
+
+
+def upload_poster_once(school_id: str, page_id: str, access_token: str, image_path: str, message: str = BIRTHDAY_MESSAGE) -> dict:
+    """
+    Upload a poster unless the upload ledger shows it was already posted for this school.
+    Returns the Graph API response, or {"id": <previous post id>, "skipped": True}.
+    """
+    content_hash = render_cache.file_hash(image_path)
+    # Claimed atomically, so concurrent uploaders (jobs, API, CLI) never both post it
+    if not upload_ledger.claim(school_id, content_hash, image_path):
+        post_id = upload_ledger.find_post(school_id, content_hash)
+        print(f"⏭ {os.path.basename(image_path)} already posted as {post_id}")
+        return {"id": post_id, "skipped": True}
+
+    try:
+        result = upload_poster(page_id, access_token, image_path, message)
+    except BaseException:
+        upload_ledger.release(school_id, content_hash)
+        raise
+    upload_ledger.record(school_id, content_hash, image_path, result.get("id"))
+    return result
+
+
+def upload_unpublished_photo(page_id: str, access_token: str, image_path: str) -> str:
+    """
+    Upload a photo to the page without publishing it, so it can be attached to a feed post.
+    Returns the photo id.
+    """
+    print(f"📤 Uploading {os.path.basename(image_path)} (unpublished) to Facebook Page {page_id}...")
+    result = _graph_post(page_id, "photos", {"published": "false", "access_token": access_token}, image_path)
+    return result["id"]
+
+
+def publish_photos_post(page_id: str, access_token: str, photo_ids: list, message: str = BIRTHDAY_MESSAGE) -> dict:
+    """
+    Create one feed post with all the given (unpublished) photos attached.
+    """
+    data = {"message": message, "access_token": access_token}
+    for i, photo_id in enumerate(photo_ids):
+        data[f"attached_media[{i}]"] = json.dumps({"media_fbid": photo_id})
+    print(f"📤 Publishing one post with {len(photo_ids)} photos to Facebook Page {page_id}...")
+    return _graph_post(page_id, "feed", data)
+
+
+FB_UPLOAD_WORKERS = int(os.getenv("FB_UPLOAD_WORKERS", "8"))
+# Send uploads as Graph API batch requests (up to 50 photos per HTTP call)
+FB_USE_BATCH = os.getenv("FB_USE_BATCH", "false").lower() == "true"
+
+
+def _upload_batch(page_id: str, access_token: str, image_paths: list, edge: str, body: dict) -> list:
+    # Upload every image in Graph batch requests; one {"image", "result"|"error"} per path
+    operations = [{"method": "POST", "relative_url": f"{page_id}/{edge}", "body": body, "file": path} for path in image_paths]
+    print(f"📤 Uploading {len(image_paths)} posters to Facebook Page {page_id} in batch requests...")
+    try:
+        results = graph_batch(operations, access_token, page_id)
+    except Exception as e:
+        return [{"image": path, "error": str(e)} for path in image_paths]
+    return [
+        {"image": path, "result": result["body"]} if result["ok"] else {"image": path, "error": result["error"]}
+        for path, result in zip(image_paths, results)
+    ]
+
+
+def upload_posters(page_id: str, access_token: str, image_paths: list, message: str = BIRTHDAY_MESSAGE, workers: int = FB_UPLOAD_WORKERS, batch: bool = FB_USE_BATCH) -> list:
+    """
+    Upload several posters concurrently. The shared token buckets in lib.rate_limit keep the
+    request rate under the app and page limits. Returns one {"image", "result"|"error"} per path.
+    With `batch` the uploads are packed into Graph API batch requests instead.
+    """
+    if batch and image_paths:
+        return _upload_batch(page_id, access_token, image_paths, "feed", {"caption": message})
+
+    # Worker threads do not inherit the caller's deadline scope
+    at = deadline.current()
+
+    def upload(image_path):
+        try:
+            with deadline.scope(at=at):
+                return {"image": image_path, "result": upload_poster(page_id, access_token, image_path, message)}
+        except Exception as e:
+            return {"image": image_path, "error": str(e)}
+
+    if not image_paths:
+        return []
+    with ThreadPoolExecutor(max_workers=min(workers, len(image_paths))) as executor:
+        return list(executor.map(upload, image_paths))
+
+
+def post_album(page_id: str, access_token: str, image_paths: list, message: str = BIRTHDAY_MESSAGE, workers: int = FB_UPLOAD_WORKERS, batch: bool = FB_USE_BATCH) -> dict:
+    """
+    Upload all posters as unpublished photos in parallel (or in batch requests), then publish
+    a single feed post attaching all of them. Returns {"post": response, "uploads": [...]}.
+    """
+    # Worker threads do not inherit the caller's deadline scope
+    at = deadline.current()
+
+    def upload(image_path):
+        try:
+            with deadline.scope(at=at):
+                return {"image": image_path, "photo_id": upload_unpublished_photo(page_id, access_token, image_path)}
+        except Exception as e:
+            return {"image": image_path, "error": str(e)}
+
+    if not image_paths:
+        return {"post": None, "uploads": []}
+    if batch:
+        uploads = [
+            {"image": upload["image"], "photo_id": upload["result"]["id"]} if "result" in upload else upload
+            for upload in _upload_batch(page_id, access_token, image_paths, "photos", {"published": "false"})
+        ]
+    else:
+        with ThreadPoolExecutor(max_workers=min(workers, len(image_paths))) as executor:
+            uploads = list(executor.map(upload, image_paths))
+
+    photo_ids = [upload["photo_id"] for upload in uploads if "photo_id" in upload]
+    if not photo_ids:
+        raise Exception("❌ No photos could be uploaded")
+    return {"post": publish_photos_post(page_id, access_token, photo_ids, message), "uploads": uploads}
+
+
+# "single": one feed post per poster, "multi": one feed post with every poster attached
+FB_POST_MODE = os.getenv("FB_POST_MODE", "single")
+
+
+def post_on_facebook(school_id="testschool", mode: str = None, manifest_path: str = None):
     """
-    Upload all generated posters from the output folder directly to the Facebook Page.
+    Upload the posters rendered today for the school directly to the Facebook Page.
+    Posters are taken from the run manifest at `manifest_path`, or from all of today's
+    manifests for the school, so the outputs folder is never scanned.
     Uses the page_id and access_token fetched dynamically from the configuration table
     and fb_pages.json.
+    In "multi" mode all posters go into a single feed post instead of one post each.
     """
     # 1️⃣ Get page_id and access_token dynamically
     try:
@@ -191,41 +474,53 @@ def post_on_facebook(output_folder="outputs", school_id="testschool"):
     if not page_id or not access_token:
         raise Exception("❌ Page ID or Access Token missing")
 
-    # Find all images in outputs folder (png/jpg/jpeg)
-    image_paths = glob(os.path.join(output_folder, "*.png")) + \
-                  glob(os.path.join(output_folder, "*.jpg")) + \
-                  glob(os.path.join(output_folder, "*.jpeg"))
-
-    if not image_paths:
-        print("⚠ No images found in output folder.")
+    # Posters rendered by this run (or today)
+    entries = read_manifest(manifest_path)["entries"] if manifest_path else todays_entries(school_id)
+    if not entries:
+        print("⚠ No posters rendered today.")
         return
 
-    # 3️⃣ Upload each poster
-    for image_path in image_paths:
-        print(f"📤 Uploading {os.path.basename(image_path)} to Facebook Page {page_id}...")
-
-        fb_url = f"https://graph.facebook.com/v23.0/{page_id}/feed"
-        message = f"🎂 Happy Birthday from Our Whole School Family! 🎉"
-
-        # Facebook API requires multipart/form-data for direct image uploads
-        with open(image_path, "rb") as img_file:
-            files = {
-                "source": img_file
-            }
-            data = {
-                "caption": message,
-                "access_token": access_token
-            }
-            response = requests.post(fb_url, files=files, data=data)
+    # 2️⃣ Claim the posters in the upload ledger; skip those already posted (or being posted)
+    hashes = {entry["file"]: entry["hash"] for entry in entries}
+    image_paths = [path for path, content_hash in hashes.items() if upload_ledger.claim(school_id, content_hash, path)]
+    if not image_paths:
+        print("ℹ All posters were already posted.")
+        return []
 
+    # 3️⃣ Upload the posters concurrently (rate limited)
+    if (mode or FB_POST_MODE) == "multi":
         try:
-            response.raise_for_status()
-            print(f"✅ Posted successfully: {response.json()}")
-        except Exception as e:
-            print(f"❌ Failed to post {image_path}: {e}")
-            print(f"Response: {response.text}")
+            album = post_album(page_id, access_token, image_paths)
+        except BaseException:
+            for path in image_paths:
+                upload_ledger.release(school_id, hashes[path])
+            raise
+        for upload in album["uploads"]:
+            if "error" in upload:
+                print(f"❌ Failed to upload {upload['image']}: {upload['error']}")
+                upload_ledger.release(school_id, hashes[upload["image"]])
+            else:
+                upload_ledger.record(school_id, hashes[upload["image"]], upload["image"], album["post"].get("id"))
+        posted = sum(1 for upload in album["uploads"] if "photo_id" in upload)
+        print(f"🎉 Posted {posted} posters in one Facebook post: {album['post']}")
+        return album
+
+    try:
+        results = upload_posters(page_id, access_token, image_paths)
+    except BaseException:
+        for path in image_paths:
+            upload_ledger.release(school_id, hashes[path])
+        raise
+    for upload in results:
+        if "error" in upload:
+            print(f"❌ Failed to post {upload['image']}: {upload['error']}")
+            upload_ledger.release(school_id, hashes[upload["image"]])
+        else:
+            upload_ledger.record(school_id, hashes[upload["image"]], upload["image"], upload["result"].get("id"))
+            print(f"✅ Posted successfully: {upload['result']}")
 
     print("🎉 All posters uploaded directly to Facebook!")
+    return results
 
 
 
@@ -235,6 +530,6 @@ def upload_file():
 
     with open(file_path, "rb") as f:
         files = {"file": f}
-        resp = requests.post(url, files=files)
+        resp = http_client.post(url, files=files)
 
     return resp.json()
\ No newline at end of file
@@ -0,0 +1,150 @@
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Mapping
+
+from lib import deadline
+
+logger = logging.getLogger(__name__)
+
+# Steady request rate (per second) and burst size for the whole app and for each page
+FB_APP_RATE = float(os.getenv("FB_APP_RATE", "20"))
+FB_APP_BURST = int(os.getenv("FB_APP_BURST", "20"))
+FB_PAGE_RATE = float(os.getenv("FB_PAGE_RATE", "10"))
+FB_PAGE_BURST = int(os.getenv("FB_PAGE_BURST", "10"))
+# Start slowing down once reported usage (percent of the Graph API quota) passes this value
+FB_USAGE_SLOWDOWN = float(os.getenv("FB_USAGE_SLOWDOWN", "50"))
+# How long to stop calling once usage hits 100% and Facebook gives no estimate
+FB_THROTTLE_PAUSE = float(os.getenv("FB_THROTTLE_PAUSE", "60"))
+# Graph API error codes that mean "too many calls"
+THROTTLE_ERROR_CODES = {4, 17, 32, 613}
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. `factor` (0..1] scales the refill rate down when
+    the Graph API reports high usage, and `pause` blocks all callers for a while.
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.factor = 1.0
+        self.paused_until = 0.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate * self.factor)
+        self.updated = now
+
+    def acquire(self):
+        # Block until one token is available, or until the current request deadline (lib.deadline) runs out
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / (self.rate * self.factor)
+            deadline.check("Graph API call (rate limited)")
+            left = deadline.remaining()
+            time.sleep(wait if left is None else max(0.0, min(wait, left)))
+
+    def slow_down(self, usage: float):
+        # Scale the refill rate down linearly from FB_USAGE_SLOWDOWN% to 100% usage
+        with self.lock:
+            self._refill(time.monotonic())
+            if usage <= FB_USAGE_SLOWDOWN:
+                self.factor = 1.0
+            else:
+                self.factor = max(0.05, (100 - usage) / (100 - FB_USAGE_SLOWDOWN))
+
+    def pause(self, seconds: float):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+_app_bucket = TokenBucket(FB_APP_RATE, FB_APP_BURST)
+_page_buckets: Dict[str, TokenBucket] = {}
+_page_lock = threading.Lock()
+
+
+def _page_bucket(page_id: str) -> TokenBucket:
+    with _page_lock:
+        if page_id not in _page_buckets:
+            _page_buckets[page_id] = TokenBucket(FB_PAGE_RATE, FB_PAGE_BURST)
+        return _page_buckets[page_id]
+
+
+def acquire(page_id: str):
+    """
+    Wait for a slot in both the app-wide and the page's bucket before calling the Graph API.
+    """
+    _app_bucket.acquire()
+    _page_bucket(page_id).acquire()
+
+
+def _usage_percent(header: str) -> float:
+    # X-App-Usage / X-Page-Usage: {"call_count": 12, "total_cputime": 3, "total_time": 5}
+    try:
+        usage = json.loads(header)
+    except ValueError:
+        return 0.0
+    return max((float(v) for v in usage.values() if isinstance(v, (int, float))), default=0.0)
+
+
+def _regain_seconds(headers: Mapping[str, str]) -> float:
+    # X-Business-Use-Case-Usage carries estimated_time_to_regain_access (minutes) per business id
+    try:
+        usage = json.loads(headers.get("X-Business-Use-Case-Usage", "{}"))
+        minutes = max(
+            (entry.get("estimated_time_to_regain_access", 0) for entries in usage.values() for entry in entries),
+            default=0
+        )
+    except (ValueError, AttributeError, TypeError):
+        minutes = 0
+    return minutes * 60 or FB_THROTTLE_PAUSE
+
+
+def observe(page_id: str, headers: Mapping[str, str]):
+    """
+    Adapt the app and page buckets to the usage Facebook reports on every response,
+    slowing down before the quota runs out and pausing once it has.
+    """
+    for header, bucket in (("X-App-Usage", _app_bucket), ("X-Page-Usage", _page_bucket(page_id))):
+        if header not in headers:
+            continue
+        usage = _usage_percent(headers[header])
+        bucket.slow_down(usage)
+        if usage >= 100:
+            seconds = _regain_seconds(headers)
+            logger.warning(f"{header} at {usage}% for page {page_id}, pausing {seconds}s")
+            bucket.pause(seconds)
+
+
+def throttled(page_id: str, headers: Mapping[str, str], error_code: int = None):
+    """
+    Called when a response was rejected for rate limiting (HTTP 429 or Graph error 4/17/32/613).
+    Error 4, or X-App-Usage at 100%, is the app-wide limit and pauses every page;
+    anything else pauses only this page.
+    """
+    seconds = _regain_seconds(headers)
+    app_wide = error_code == 4 or _usage_percent(headers.get("X-App-Usage", "{}")) >= 100
+    if app_wide:
+        logger.warning(f"Graph API throttled the app (page {page_id}), pausing all pages {seconds}s")
+        _app_bucket.pause(seconds)
+    else:
+        logger.warning(f"Graph API throttled page {page_id}, pausing {seconds}s")
+        _page_bucket(page_id).pause(seconds)
+
+
+__all__ = ["TokenBucket", "acquire", "observe", "throttled", "THROTTLE_ERROR_CODES"]
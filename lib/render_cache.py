@@ -0,0 +1,198 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Dict, Any, Optional
+from lib.storage import atomic_copy
+from lib import metrics
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever replace_circle output changes for the same inputs
+RENDERER_VERSION = "1"
+
+CACHE_DIR = os.getenv("RENDER_CACHE_DIR", os.path.join("cache", "renders"))
+CACHE_MAX_BYTES = int(os.getenv("RENDER_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+_lock = threading.Lock()
+# key -> size in bytes, ordered from least to most recently used
+_index: "OrderedDict[str, int]" = OrderedDict()
+_index_loaded = False
+_total_bytes = 0
+stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+# path -> (mtime_ns, size, sha256) so unchanged files are hashed only once; least recently used
+# first and bounded, since every run also hashes its outputs under a new directory
+HASH_MEMO_SIZE = int(os.getenv("RENDER_HASH_MEMO_SIZE", "4096"))
+_hash_memo: "OrderedDict[str, tuple]" = OrderedDict()
+_hash_lock = threading.Lock()
+
+
+def file_hash(path: str) -> str:
+    """
+    SHA-256 of a file's content, read in chunks.
+    Memoized on (mtime, size) so repeated lookups of an unchanged file are free.
+    """
+    st = os.stat(path)
+    with _hash_lock:
+        memo = _hash_memo.get(path)
+        if memo and memo[0] == st.st_mtime_ns and memo[1] == st.st_size:
+            _hash_memo.move_to_end(path)
+            return memo[2]
+
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    with _hash_lock:
+        _hash_memo[path] = (st.st_mtime_ns, st.st_size, h.hexdigest())
+        _hash_memo.move_to_end(path)
+        while len(_hash_memo) > HASH_MEMO_SIZE:
+            _hash_memo.popitem(last=False)
+    return h.hexdigest()
+
+
+def render_key(template_hash: str, photo_hash: str, old_text: str, new_text: str, variants: list = None) -> str:
+    """
+    Cache key for a render: content hashes of all inputs plus the renderer version.
+    """
+    payload = json.dumps({
+        "renderer": RENDERER_VERSION,
+        "template": template_hash,
+        "photo": photo_hash,
+        "old_text": old_text,
+        "new_text": new_text,
+        "variants": variants or [],
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _entry_dir(key: str) -> str:
+    return os.path.join(CACHE_DIR, key)
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def _load_index():
+    # Rebuild the LRU order from the entries already on disk (oldest mtime first)
+    global _index_loaded, _total_bytes
+    if _index_loaded:
+        return
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        path = _entry_dir(name)
+        if name.startswith(".") or not os.path.isfile(os.path.join(path, "meta.json")):
+            continue
+        entries.append((os.path.getmtime(path), name, _dir_size(path)))
+    for _, name, size in sorted(entries):
+        _index[name] = size
+        _total_bytes += size
+    _index_loaded = True
+
+
+def _evict():
+    # Drop least recently used entries until the cache fits in CACHE_MAX_BYTES
+    global _total_bytes
+    while _total_bytes > CACHE_MAX_BYTES and len(_index) > 1:
+        key, size = _index.popitem(last=False)
+        shutil.rmtree(_entry_dir(key), ignore_errors=True)
+        _total_bytes -= size
+        stats["evictions"] += 1
+        metrics.inc("render_cache_evictions_total")
+        logger.info(f"Render cache evicted {key} ({size} bytes)")
+
+
+def get(key: str) -> Optional[Dict[str, Any]]:
+    """
+    Return the cached entry {"main": path, "variants": {name: path}} or None.
+    A hit marks the entry as most recently used.
+    """
+    with _lock:
+        _load_index()
+        if key not in _index:
+            stats["misses"] += 1
+            metrics.inc("render_cache_lookups_total", result="miss")
+            return None
+        _index.move_to_end(key)
+        stats["hits"] += 1
+        metrics.inc("render_cache_lookups_total", result="hit")
+
+    path = _entry_dir(key)
+    try:
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        os.utime(path)
+    except OSError:
+        with _lock:
+            _index.pop(key, None)
+        return None
+
+    return {
+        "main": os.path.join(path, meta["main"]),
+        "variants": {name: os.path.join(path, file) for name, file in meta["variants"].items()},
+    }
+
+
+def put(key: str, main_path: str, variant_paths: Dict[str, str] = None):
+    """
+    Store the encoded output files of a render under `key`.
+    The entry is assembled in a temp directory and renamed into place.
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_dir = os.path.join(CACHE_DIR, f".tmp-{uuid.uuid4().hex}")
+    os.makedirs(tmp_dir)
+
+    meta = {"main": "main" + os.path.splitext(main_path)[1], "variants": {}}
+    shutil.copyfile(main_path, os.path.join(tmp_dir, meta["main"]))
+    for name, path in (variant_paths or {}).items():
+        file = name + os.path.splitext(path)[1]
+        shutil.copyfile(path, os.path.join(tmp_dir, file))
+        meta["variants"][name] = file
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+    size = _dir_size(tmp_dir)
+    global _total_bytes
+    with _lock:
+        _load_index()
+        try:
+            os.rename(tmp_dir, _entry_dir(key))
+        except OSError:
+            # Another worker stored the same render first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        _index[key] = size
+        _total_bytes += size
+        _evict()
+
+
+def restore(entry: Dict[str, Any], output_folder: str, base_name: str) -> Dict[str, Any]:
+    """
+    Copy a cached entry to the locations replace_circle would have written.
+    """
+    file_path = os.path.join(output_folder, base_name + os.path.splitext(entry["main"])[1])
+    atomic_copy(entry["main"], file_path)
+
+    variant_paths = {}
+    for name, cached in entry["variants"].items():
+        variant_dir = os.path.join(output_folder, "variants", name)
+        os.makedirs(variant_dir, exist_ok=True)
+        variant_paths[name] = os.path.join(variant_dir, base_name + os.path.splitext(cached)[1])
+        atomic_copy(cached, variant_paths[name])
+
+    return {"file": file_path, "variants": variant_paths}
+
+
+__all__ = ["RENDERER_VERSION", "file_hash", "render_key", "get", "put", "restore", "stats"]
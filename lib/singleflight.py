@@ -0,0 +1,97 @@
+import asyncio
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Hashable
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+_lock = threading.Lock()
+# key -> {"done": Event, "result": ..., "error": ...} for calls currently running
+_calls: Dict[Hashable, Dict[str, Any]] = {}
+# key -> {"task": asyncio task, "waiters": int} for coalesced coroutines (event loop only, no lock needed)
+_tasks: Dict[Hashable, Dict[str, Any]] = {}
+
+
+def do(key: Hashable, fn: Callable[[], Any]) -> Any:
+    """
+    Run fn() once for concurrent callers with the same key: the first caller runs it,
+    everyone else arriving before it finishes waits and gets the same result (or exception).
+    """
+    with _lock:
+        call = _calls.get(key)
+        leader = call is None
+        if leader:
+            call = {"done": threading.Event(), "result": None, "error": None}
+            _calls[key] = call
+
+    if not leader:
+        call["done"].wait()
+        if call["error"] is not None:
+            raise call["error"]
+        return call["result"]
+
+    try:
+        call["result"] = fn()
+        return call["result"]
+    except BaseException as e:
+        call["error"] = e
+        raise
+    finally:
+        with _lock:
+            del _calls[key]
+        call["done"].set()
+
+
+async def do_async(key: Hashable, fn: Callable[[], Any]) -> Any:
+    """
+    Async version of do(): fn() returns a coroutine that runs once per key while in flight.
+    Callers are shielded, so one caller going away does not cancel the work for the others;
+    the coroutine is cancelled only once every caller waiting for it has been cancelled.
+    """
+    call = _tasks.get(key)
+    if call is None:
+        call = {"task": asyncio.ensure_future(fn()), "waiters": 0}
+        _tasks[key] = call
+        # Only if still ours: a cancelled call is replaced before its task has finished
+        call["task"].add_done_callback(lambda _: _tasks.get(key) is call and _tasks.pop(key))
+    call["waiters"] += 1
+    try:
+        return await asyncio.shield(call["task"])
+    except asyncio.CancelledError:
+        if not call["task"].done() and call["waiters"] == 1:
+            # Unregister first, so a caller arriving now starts fresh instead of joining a dying task
+            if _tasks.get(key) is call:
+                del _tasks[key]
+            call["task"].cancel()
+        raise
+    finally:
+        call["waiters"] -= 1
+
+
+@contextmanager
+def file_lock(path: str):
+    """
+    Exclusive lock on `<path>.lock`, held across processes (uvicorn workers, cron runs).
+    Blocks until the lock is free.
+    """
+    with open(f"{path}.lock", "a+") as f:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+__all__ = ["do", "do_async", "file_lock"]
@@ -0,0 +1,106 @@
+import os
+import re
+import shutil
+import uuid
+from contextlib import contextmanager
+from datetime import date
+
+UPLOAD_DIR = "uploads"
+OUTPUT_DIR = "outputs"
+
+# Layout (one namespace per school, so schools and concurrent runs never collide):
+#   uploads/<school_id>/students/<photo>                 downloaded student photos (shared by runs)
+#   uploads/<school_id>/templates/<run_id>_<filename>    poster template uploaded for a run
+#   uploads/<school_id>/templates/current                name of the school's latest template
+#   outputs/<school_id>/<date>/<run_id>/                 posters rendered by a run
+
+
+# school_id becomes a directory (and SQL schema) name, so only plain identifiers are accepted
+_SCHOOL_ID = re.compile(r"^[A-Za-z0-9_]+$")
+
+
+def check_school_id(school_id: str) -> str:
+    """
+    Return `school_id`, or raise ValueError if it is not a plain identifier (e.g. "../x").
+    """
+    if not isinstance(school_id, str) or not _SCHOOL_ID.match(school_id):
+        raise ValueError(f"Invalid school_id: {school_id!r}")
+    return school_id
+
+
+def photo_path(school_id: str, photo: str) -> str:
+    folder = os.path.join(UPLOAD_DIR, check_school_id(school_id), "students")
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, os.path.basename(photo))
+
+
+def template_path(school_id: str, run_id: str, filename: str) -> str:
+    folder = os.path.join(UPLOAD_DIR, check_school_id(school_id), "templates")
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, f"{run_id}_{os.path.basename(filename)}")
+
+
+def set_current_template(school_id: str, path: str):
+    """
+    Make `path` (a file from template_path) the school's current template, for every worker
+    process and across restarts.
+    """
+    with atomic_write(os.path.join(UPLOAD_DIR, check_school_id(school_id), "templates", "current"), "w") as f:
+        f.write(os.path.basename(path))
+
+
+def current_template(school_id: str, default: str = None) -> str:
+    """
+    Path of the school's current template, or `default` if none was uploaded yet.
+    """
+    folder = os.path.join(UPLOAD_DIR, check_school_id(school_id), "templates")
+    try:
+        with open(os.path.join(folder, "current")) as f:
+            path = os.path.join(folder, f.read().strip())
+    except FileNotFoundError:
+        return default
+    return path if os.path.exists(path) else default
+
+
+def output_dir(school_id: str, run_id: str, day: date = None) -> str:
+    folder = os.path.join(OUTPUT_DIR, check_school_id(school_id), (day or date.today()).isoformat(), run_id)
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def _tmp_path(path: str) -> str:
+    # Same directory as the target so the final rename is atomic
+    return os.path.join(os.path.dirname(path) or ".", f".{os.path.basename(path)}.{uuid.uuid4().hex}.tmp")
+
+
+@contextmanager
+def atomic_write(path: str, mode: str = "wb"):
+    """
+    Open a temp file next to `path` and rename it over `path` only once writing succeeded,
+    so readers (and concurrent writers of the same file) never see a partial file.
+    """
+    tmp_path = _tmp_path(path)
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def atomic_save_image(image, path: str, **params):
+    """
+    PIL Image.save through atomic_write. `format` must be given since the temp name has no extension.
+    """
+    with atomic_write(path) as f:
+        image.save(f, **params)
+
+
+def atomic_copy(src: str, dst: str):
+    with open(src, "rb") as source, atomic_write(dst) as target:
+        shutil.copyfileobj(source, target)
+
+
+__all__ = ["UPLOAD_DIR", "OUTPUT_DIR", "check_school_id", "photo_path", "template_path", "set_current_template", "current_template", "output_dir", "atomic_write", "atomic_save_image", "atomic_copy"]
@@ -0,0 +1,125 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import date, timedelta
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_LEDGER_DB = os.getenv("UPLOAD_LEDGER_DB", "upload_ledger.sqlite3")
+# A poster with the same content is not posted again for this many days
+# (the same photo and name render the same poster again next birthday)
+UPLOAD_LEDGER_WINDOW_DAYS = int(os.getenv("UPLOAD_LEDGER_WINDOW_DAYS", "300"))
+# A claim (row without post id) older than this (seconds) is assumed to be from a dead uploader
+UPLOAD_CLAIM_TTL = int(os.getenv("UPLOAD_CLAIM_TTL", "900"))
+
+# find_post() result for a poster another uploader is posting right now
+PENDING = "pending"
+
+_lock = threading.Lock()
+_conn: Optional[sqlite3.Connection] = None
+
+
+def _connection() -> sqlite3.Connection:
+    # Caller must hold _lock
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(UPLOAD_LEDGER_DB, check_same_thread=False)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute("""
+            CREATE TABLE IF NOT EXISTS uploads (
+                school_id TEXT NOT NULL,
+                day TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                image_path TEXT,
+                post_id TEXT,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (school_id, day, content_hash)
+            )
+        """)
+        _conn.execute("CREATE INDEX IF NOT EXISTS uploads_school_hash ON uploads (school_id, content_hash, day)")
+        _conn.commit()
+    return _conn
+
+
+def _find(conn: sqlite3.Connection, school_id: str, content_hash: str, day: date) -> Optional[str]:
+    since = day - timedelta(days=UPLOAD_LEDGER_WINDOW_DAYS)
+    row = conn.execute(
+        "SELECT post_id FROM uploads WHERE school_id = ? AND content_hash = ? AND day BETWEEN ? AND ? "
+        "AND (post_id IS NOT NULL OR created_at > ?) ORDER BY post_id IS NULL LIMIT 1",
+        (school_id, content_hash, since.isoformat(), day.isoformat(), time.time() - UPLOAD_CLAIM_TTL)
+    ).fetchone()
+    if not row:
+        return None
+    return row[0] if row[0] is not None else PENDING
+
+
+def find_post(school_id: str, content_hash: str, day: date = None) -> Optional[str]:
+    """
+    Return the Facebook post id if this poster was already posted for the school
+    on `day` or within the UPLOAD_LEDGER_WINDOW_DAYS before it, PENDING if another
+    uploader has claimed it and is posting it right now, otherwise None.
+    """
+    with _lock:
+        return _find(_connection(), school_id, content_hash, day or date.today())
+
+
+def claim(school_id: str, content_hash: str, image_path: str, day: date = None) -> bool:
+    """
+    Reserve a poster before uploading it. Returns False when it was already posted or another
+    uploader (thread or process) holds the claim; the caller must skip it then.
+    After the upload call record() on success or release() on failure.
+    """
+    day = day or date.today()
+    with _lock:
+        conn = _connection()
+        # Write lock up front, so check and insert are atomic across processes too
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if _find(conn, school_id, content_hash, day):
+                conn.rollback()
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO uploads (school_id, day, content_hash, image_path, post_id, created_at) VALUES (?, ?, ?, ?, NULL, ?)",
+                (school_id, day.isoformat(), content_hash, image_path, time.time())
+            )
+            conn.commit()
+            return True
+        except BaseException:
+            conn.rollback()
+            raise
+
+
+def release(school_id: str, content_hash: str, day: date = None):
+    """
+    Drop a claim whose upload failed, so a later run can post the poster.
+    """
+    day = day or date.today()
+    with _lock:
+        conn = _connection()
+        conn.execute(
+            "DELETE FROM uploads WHERE school_id = ? AND day = ? AND content_hash = ? AND post_id IS NULL",
+            (school_id, day.isoformat(), content_hash)
+        )
+        conn.commit()
+
+
+def record(school_id: str, content_hash: str, image_path: str, post_id: str, day: date = None):
+    """
+    Remember that a poster has been posted (keyed by school, date and content hash).
+    This also completes the claim taken by claim().
+    """
+    day = day or date.today()
+    with _lock:
+        conn = _connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO uploads (school_id, day, content_hash, image_path, post_id, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            # A NULL post id would read as a claim; the poster is posted all the same
+            (school_id, day.isoformat(), content_hash, image_path, post_id or "unknown", time.time())
+        )
+        conn.commit()
+
+
+__all__ = ["PENDING", "find_post", "claim", "release", "record"]
@@ -0,0 +1,118 @@
+import json
+import logging
+import os
+from typing import List, Dict, Any
+from PIL import Image
+from lib.db_manager import execute_query
+from lib.storage import atomic_save_image
+
+logger = logging.getLogger(__name__)
+
+# Default output sizes produced from every composite
+# mode "fit" keeps the aspect ratio inside the box, "pad" fills the whole box
+DEFAULT_VARIANTS: List[Dict[str, Any]] = [
+    {"name": "feed", "width": 1080, "height": 1350, "format": "JPEG", "quality": 90, "mode": "fit"},
+    {"name": "story", "width": 1080, "height": 1920, "format": "JPEG", "quality": 90, "mode": "pad"},
+    {"name": "thumb", "width": 320, "height": 320, "format": "JPEG", "quality": 80, "mode": "fit"},
+]
+
+_EXTENSIONS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp"}
+
+
+def get_school_variants(school_id: str) -> List[Dict[str, Any]]:
+    """
+    Read the variant specs for a school from the `poster_variants` configuration (a JSON list).
+    Falls back to the POSTER_VARIANTS environment variable and then to DEFAULT_VARIANTS.
+    """
+    query = """
+        SELECT config_value AS poster_variants
+        FROM {0}.configurations
+        WHERE config_key = 'poster_variants'
+        AND _school = %s
+        LIMIT 1
+    """.format(school_id)
+
+    raw = None
+    result = execute_query(query, (school_id,))
+    if result:
+        raw = result[0]["poster_variants"]
+    if not raw:
+        raw = os.getenv("POSTER_VARIANTS")
+    if not raw:
+        return DEFAULT_VARIANTS
+
+    try:
+        variants = json.loads(raw) if isinstance(raw, str) else raw
+        return [_normalize_variant(v) for v in variants]
+    except (ValueError, TypeError, KeyError) as e:
+        logger.error(f"Invalid poster_variants for {school_id}: {e}")
+        return DEFAULT_VARIANTS
+
+
+def _normalize_variant(spec: Dict[str, Any]) -> Dict[str, Any]:
+    fmt = str(spec.get("format", "JPEG")).upper()
+    if fmt == "JPG":
+        fmt = "JPEG"
+    if fmt not in _EXTENSIONS:
+        raise ValueError(f"Unsupported variant format {fmt}")
+    return {
+        "name": str(spec["name"]),
+        "width": int(spec["width"]),
+        "height": int(spec["height"]),
+        "format": fmt,
+        "quality": int(spec.get("quality", 90)),
+        "mode": spec.get("mode", "fit"),
+    }
+
+
+def _fit_size(size: tuple, box: tuple) -> tuple:
+    # Largest size with the same aspect ratio that fits inside the box (never upscales)
+    scale = min(box[0] / size[0], box[1] / size[1], 1.0)
+    return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+
+def generate_variants(image: Image.Image, variants: List[Dict[str, Any]], output_folder: str, base_name: str) -> Dict[str, str]:
+    """
+    Downscale one composite into every configured variant in a single pass.
+    Variants are processed from largest to smallest and each one starts from the
+    smallest pyramid level (halved with Image.reduce) that is still larger than the target,
+    so the expensive LANCZOS resample always works on a small source.
+    Files are written to <output_folder>/variants/<name>/<base_name>.<ext>
+    """
+    outputs = {}
+    if not variants:
+        return outputs
+
+    # Image pyramid: level 0 is the full composite, each level is half of the previous one
+    pyramid = [image]
+
+    ordered = sorted(variants, key=lambda v: v["width"] * v["height"], reverse=True)
+    for spec in ordered:
+        target = _fit_size(image.size, (spec["width"], spec["height"]))
+
+        level = pyramid[-1]
+        while level.width // 2 >= target[0] and level.height // 2 >= target[1]:
+            level = level.reduce(2)
+            pyramid.append(level)
+        # Walk back to the smallest level that still covers the target
+        source = next(p for p in reversed(pyramid) if p.width >= target[0] and p.height >= target[1])
+
+        resized = source if source.size == target else source.resize(target, Image.LANCZOS)
+        if spec["mode"] == "pad":
+            canvas = Image.new("RGBA", (spec["width"], spec["height"]), (255, 255, 255, 255))
+            canvas.paste(resized, ((spec["width"] - target[0]) // 2, (spec["height"] - target[1]) // 2))
+            resized = canvas
+
+        if spec["format"] in ("JPEG",):
+            resized = resized.convert("RGB")
+
+        variant_dir = os.path.join(output_folder, "variants", spec["name"])
+        os.makedirs(variant_dir, exist_ok=True)
+        path = os.path.join(variant_dir, f"{base_name}.{_EXTENSIONS[spec['format']]}")
+        atomic_save_image(resized, path, format=spec["format"], quality=spec["quality"])
+        outputs[spec["name"]] = path
+
+    return outputs
+
+
+__all__ = ["DEFAULT_VARIANTS", "get_school_variants", "generate_variants"]
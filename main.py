@@ -1,12 +1,36 @@
-from fastapi import FastAPI, UploadFile, File, Form
+from fastapi import FastAPI, UploadFile, File, Form, Request, Response, HTTPException
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse, PlainTextResponse
+from fastapi.concurrency import run_in_threadpool
+from contextlib import nullcontext, suppress
+from datetime import date
+import asyncio
+import hashlib
+import io
+import json
 import logging
 import os
-import requests
+import time
+import zipfile
 import shutil
-from lib.process_imag import replace_circle, capitalize_name, post_on_facebook 
-from lib.db_manager import execute_query
+import threading
+from lib.process_imag import replace_circle, capitalize_name, post_on_facebook, upload_poster_once, upload_unpublished_photo, publish_photos_post, FB_POST_MODE
+from lib.db_manager import execute_query, pool_stats
 from dotenv import load_dotenv
 from lib.facebook_utils import get_page_access_token
+from lib.variants import get_school_variants
+from lib import render_cache
+from lib.jobs import submit_job, get_job, iter_events
+from lib.pipeline import run_pipeline
+from lib import upload_ledger
+from lib import page_store
+from lib import singleflight
+from lib import http_client
+from lib import deadline
+from lib import admission
+from lib import metrics
+from lib import memory_governor
+from lib.manifest import new_run_id, manifest_entry, manifest_path, write_manifest
+from lib.storage import UPLOAD_DIR, OUTPUT_DIR, check_school_id, photo_path, template_path, set_current_template, current_template, output_dir, atomic_write
 
 # Load variables from .env file into environment
 load_dotenv()
@@ -16,96 +40,514 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = FastAPI()
-UPLOAD_DIR = "uploads"
-OUTPUT_DIR = "outputs"
+
+@app.exception_handler(admission.Saturated)
+async def saturated_handler(request: Request, exc: admission.Saturated):
+    # All render slots busy and the wait queue full: tell the client when to come back
+    return JSONResponse(status_code=429, content={"detail": str(exc)}, headers={"Retry-After": str(exc.retry_after)})
+
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(OUTPUT_DIR, exist_ok=True)
+DEFAULT_TEMPLATE = "poster_template.jpg"
+DEFAULT_OLD_TEXT = "www.reallygreatsite.com"
+POSTER_MAX_AGE = int(os.getenv("POSTER_MAX_AGE", "300"))
+ZIP_RENDER_WORKERS = int(os.getenv("ZIP_RENDER_WORKERS", "4"))
+# Time budget (seconds) for a whole /replace-circle/, GET /posters/ or /post-on-facebook/ request,
+# and for each poster upload of a job or CLI run
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", "120"))
+# How often (seconds) a long request checks whether its client is still connected
+DISCONNECT_POLL_INTERVAL = float(os.getenv("DISCONNECT_POLL_INTERVAL", "0.5"))
+
+
+def _check_school_id(school_id: str):
+    # Reject ids that are not plain identifiers before they reach paths or SQL
+    try:
+        check_school_id(school_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 
-# Download photo from URL and save locally
-def _downloadPhoto(school_id:str, photo_id: str):
+# Download photo from URL and save locally (uploads/<school_id>/students/<photo_id>)
+def _downloadPhoto(school_id:str, photo_id: str) -> str:
     url = f"https://schoolerp-bucket.blr1.cdn.digitaloceanspaces.com/supa-img/{school_id}/students/{photo_id}?1758114330329"
     logger.info(f"Downloading image from URL: {url}")
-    response = requests.get(url, stream=True)
+    path = photo_path(school_id, photo_id)
+    started = time.perf_counter()
+    response = http_client.get(url, stream=True)
     if response.status_code == 200:
-        with open(os.path.join(UPLOAD_DIR, photo_id), 'wb') as out_file:
+        with atomic_write(path) as out_file:
             shutil.copyfileobj(response.raw, out_file)
+            size = out_file.tell()
         logger.info("Image downloaded successfully.")
+        metrics.observe("cdn_download_bytes", size, buckets=metrics.BYTES_BUCKETS)
     else:
         logger.error("Failed to download image.")
+    # Headers and body, unlike http_request_duration_seconds which stops at the headers
+    metrics.observe("cdn_download_duration_seconds", time.perf_counter() - started, status=response.status_code)
+    return path
 
 
 def fetch_and_store_pages(user_access_token: str, output_file="fb_pages.json"):
     """
-    Fetch all pages the user manages and store the response to a JSON file.
-    This should be done only once (or periodically).
+    Fetch all pages the user manages (every cursor of /me/accounts) and store them to a JSON file
+    and the page store. This should be done only once (or periodically).
+    Returns the diff report of added/removed/updated page ids.
     """
-    fb_url = f"https://graph.facebook.com/v21.0/me/accounts?access_token={user_access_token}"
-    response = requests.get(fb_url)
-    response.raise_for_status()
+    # Same lock as the bootstrap in get_page_access_token, so only one refresh runs at a time
+    with singleflight.file_lock(output_file):
+        report = page_store.sync_pages(user_access_token, output_file)
 
-    with open(output_file, "w") as f:
-        f.write(response.text)
+    print(f"✅ Facebook pages stored in {output_file}: {report['total']} pages, "
+          f"{len(report['added'])} added, {len(report['removed'])} removed, {len(report['updated'])} updated")
+    return report
 
-    print(f"✅ Facebook pages stored in {output_file}")
-    return response.json()
 
+def _save_template(school_id: str, run_id: str, poster: UploadFile) -> str:
+    # Save the uploaded poster template and remember it as the school's current one
+    path = template_path(school_id, run_id, poster.filename)
+    with atomic_write(path) as f:
+        shutil.copyfileobj(poster.file, f)
+    set_current_template(school_id, path)
+    return path
 
-async def _get_photos(school_id: str = Form(...)) -> dict:
-    logger.info(f"Received request with school_id: {school_id}")
 
-    # fee_categories = execute_query("SELECT _uid, batches, category_name FROM thekatarahillsschool.finance_fee_categories WHERE is_deleted = %s", (False,))  
-    students = execute_query(f"select full_name, photo, dob from {school_id}.students where is_deleted = false and length(photo) > 0 and TO_CHAR(CAST(dob AS DATE), 'MM-DD') = TO_CHAR(CURRENT_DATE, 'MM-DD')")
-    for student in students:
-        logger.info(f" Student FullName: {student['full_name']}, Student Photo: {student['photo']}, DOB : {student['dob']}")
-        _downloadPhoto(school_id, student['photo'])
+def _get_birthday_students(school_id: str) -> list:
+    return execute_query(f"select _uid, full_name, photo, dob from {school_id}.students where is_deleted = false and length(photo) > 0 and TO_CHAR(CAST(dob AS DATE), 'MM-DD') = TO_CHAR(CURRENT_DATE, 'MM-DD')")
+
+
+def _replace_circle_batch(school_id: str, run_id: str, poster_path: str, old_text: str, deadline_at: float = None, cancel: threading.Event = None) -> dict:
+    # Everything below (DB, downloads, OCR) shares the request's time budget and stops once cancelled
+    with deadline.scope(at=deadline_at, cancel=cancel):
+        # Fetch Students image who has birthday today
+        logger.info(f"Received request with school_id: {school_id}")
+        try:
+            students = _get_birthday_students(school_id)
+            if not students:
+                return {"output": "No students with birthdays today."}
+
+            # Output sizes configured for this school
+            variants = get_school_variants(school_id)
+        except deadline.DeadlineExceeded as e:
+            # Nothing rendered yet, so there is no partial result to return
+            raise HTTPException(status_code=504, detail=str(e))
+
+        # Process each student photo
+        results = []
+        entries = []
+        output_folder = output_dir(school_id, run_id)
+        print(f"Students with birthdays today: {photo_path(school_id, students[0]['photo'])}")
+        for index, student in enumerate(students):
+            logger.info(f" Student FullName: {student['full_name']}, Student Photo: {student['photo']}, DOB : {student['dob']}")
+            try:
+                _downloadPhoto(school_id, student['photo'])
+                result = replace_circle(
+                    photo_path(school_id, student['photo']),
+                    poster_path,
+                    output_folder,
+                    old_text,
+                    capitalize_name(student['full_name']),
+                    variants
+                )
+                results.append({"student": student['full_name'], "result": result})
+                entries.append(manifest_entry(school_id, student, result))
+            except deadline.DeadlineExceeded as e:
+                # Out of time: return what is done, the rest is reported as skipped
+                logger.warning(f"{e}; skipping {len(students) - index} students")
+                results.extend({"student": s['full_name'], "error": str(e), "skipped": True} for s in students[index:])
+                break
+            except Exception as e:
+                logger.error(f"Error processing {student['photo']}: {e}")
+                results.append({"student": student['full_name'], "error": str(e)})
 
-    return {"output": students}
+    # The uploader reads this run's posters from the manifest (POST /post-on-facebook/ with run_id)
+    manifest = write_manifest(school_id, run_id, entries)
+    return {"output": results, "run_id": run_id, "manifest": manifest, "partial": any(r.get("skipped") for r in results)}
+
+async def _cancel_on_disconnect(request: Request, coro):
+    """
+    Await `coro`, cancelling it as soon as the HTTP client disconnects.
+    """
+    task = asyncio.ensure_future(coro)
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+        if done:
+            return task.result()
+        if await request.is_disconnected():
+            logger.info(f"Client disconnected from {request.url.path}, cancelling its work")
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+            # Nobody reads this, it only shows up in access logs (nginx's "client closed request")
+            return Response(status_code=499)
+
+async def _run_leased(lease: admission.Lease, fn, *args):
+    """
+    Run fn(*args) in a worker thread that holds `lease` until it returns. Awaiting callers can be
+    cancelled right away, but the slot stays taken as long as the thread is still rendering.
+    """
+    def leased():
+        with lease:
+            return fn(*args)
+    return await asyncio.shield(asyncio.get_running_loop().run_in_executor(None, leased))
 
 # API endpoint to replace circle in image
 @app.post("/replace-circle/")
-async def replace_circle_api(school_id: str = Form(...),  poster: UploadFile = File(...), old_text:str = Form("www.reallygreatsite.com")) -> dict:
+async def replace_circle_api(request: Request, school_id: str = Form(...),  poster: UploadFile = File(...), old_text:str = Form("www.reallygreatsite.com")) -> dict:
     logger.info(f"Received request with school_id: {school_id}, old_text: {old_text}")
-    
-     # Save base image
-    with open(f"{UPLOAD_DIR}/saved_{poster.filename}", "wb") as f:
-        shutil.copyfileobj(poster.file, f)
+    _check_school_id(school_id)
+
+    # Identical requests already running (same school, day, template and text) share one result
+    template_hash = hashlib.sha256(await poster.read()).hexdigest()
+    await poster.seek(0)
+    key = (school_id, date.today().isoformat(), template_hash, old_text)
+
+    async def run():
+        run_id = new_run_id()
+        deadline_at = time.monotonic() + REQUEST_DEADLINE
+        cancel = threading.Event()
+
+         # Save base image
+        poster_path = _save_template(school_id, run_id, poster)
+        # Waits for a render slot (time in the queue counts against the deadline) or raises Saturated
+        lease = await admission.render.acquire()
+        try:
+            return await _run_leased(lease, _replace_circle_batch, school_id, run_id, poster_path, old_text, deadline_at, cancel)
+        except asyncio.CancelledError:
+            # Every caller is gone: the batch stops before its next download/render
+            cancel.set()
+            raise
+
+    # Coalesced callers each hold the work; it is cancelled once the last one disconnects
+    return await _cancel_on_disconnect(request, singleflight.do_async(key, run))
+
+def _poster_inputs(school_id: str, student_id: str, old_text: str) -> tuple:
+    # Everything GET /posters needs before it can answer (DB, CDN download, hashing); blocking
+    students = execute_query(
+        f"select _uid, full_name, photo, dob from {school_id}.students where is_deleted = false and length(photo) > 0 and _uid = %s",
+        (student_id,)
+    )
+    if not students:
+        raise HTTPException(status_code=404, detail="Student not found")
+    student = students[0]
+
+    student_photo_path = photo_path(school_id, student['photo'])
+    if not os.path.exists(student_photo_path):
+        _downloadPhoto(school_id, student['photo'])
+    if not os.path.exists(student_photo_path):
+        raise HTTPException(status_code=502, detail="Could not download student photo")
+
+    poster_path = current_template(school_id, DEFAULT_TEMPLATE)
+    new_text = capitalize_name(student['full_name'])
+    variants = get_school_variants(school_id)
+    cache_key = render_cache.render_key(
+        render_cache.file_hash(poster_path),
+        render_cache.file_hash(student_photo_path),
+        old_text,
+        new_text,
+        variants
+    )
+    return student_photo_path, poster_path, new_text, variants, cache_key
+
+@app.get("/posters/{school_id}/{student_id}")
+async def get_poster_api(request: Request, school_id: str, student_id: str, variant: str = None, old_text: str = DEFAULT_OLD_TEXT):
+    """
+    Serve a student's poster, rendering it only the first time its inputs are seen.
+    The ETag is the render cache key, so it can be checked before anything is rendered.
+    """
+    _check_school_id(school_id)
+    # The budget covers the lookups and download as well as the render
+    deadline_at = time.monotonic() + REQUEST_DEADLINE
+
+    def inputs():
+        with deadline.scope(at=deadline_at):
+            return _poster_inputs(school_id, student_id, old_text)
+
+    try:
+        student_photo_path, poster_path, new_text, variants, cache_key = await run_in_threadpool(inputs)
+    except deadline.DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    if variant and variant not in {v["name"] for v in variants}:
+        raise HTTPException(status_code=404, detail=f"Unknown variant {variant}")
+
+    etag = f'"{cache_key}-{variant}"' if variant else f'"{cache_key}"'
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={POSTER_MAX_AGE}"}
+
+    # Client already has this exact poster
+    if etag in [t.strip() for t in request.headers.get("if-none-match", "").split(",")]:
+        metrics.inc("poster_requests_total", result="not_modified")
+        return Response(status_code=304, headers=headers)
+
+    def cached():
+        entry = render_cache.get(cache_key)
+        # Evicted by another request since get(): FileResponse would fail with a 500, render it again
+        if entry and not os.path.exists(entry["variants"][variant] if variant else entry["main"]):
+            return None
+        return entry
+
+    entry = await run_in_threadpool(cached)
+    metrics.inc("poster_requests_total", result="cached" if entry else "rendered")
+    if not entry:
+        logger.info(f"Rendering poster for {school_id}/{student_id} on first request")
+
+        def render():
+            with deadline.scope(at=deadline_at):
+                return replace_circle(student_photo_path, poster_path, output_dir(school_id, "on-demand"), old_text, new_text, variants, cache_key=cache_key)
+
+        try:
+            lease = await admission.render.acquire()
+            result = await _run_leased(lease, render)
+        except deadline.DeadlineExceeded as e:
+            raise HTTPException(status_code=504, detail=str(e))
+        # The render is now cached under cache_key; serve it without another lookup
+        entry = {"main": result["file"], "variants": result["variants"]}
+
+    path = entry["variants"][variant] if variant else entry["main"]
+    media_type = "image/png" if path.endswith(".png") else "image/webp" if path.endswith(".webp") else "image/jpeg"
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+class _ZipStream(io.RawIOBase):
+    """
+    Write-only, non-seekable sink for zipfile. Bytes are collected until drained
+    so the archive can be streamed chunk by chunk instead of buffered whole.
+    """
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
 
-    # Fetch Students image who has birthday today
-    students = await _get_photos(school_id)
-    if not students['output']:
-        return {"output": "No students with birthdays today."}
-  
-    # Process each student photo
-    results = []
-    print(f"Students with birthdays today: {os.path.join(UPLOAD_DIR,students['output'][0]['photo'])}")
-    for student in students['output']:
-         student_photo_path = os.path.join(UPLOAD_DIR, student['photo'])
-         try:
-            result = replace_circle(
-                student_photo_path,
-                f"{UPLOAD_DIR}/saved_{poster.filename}",
-                OUTPUT_DIR,
-                old_text,
-                capitalize_name(student['full_name'])
-            )
-            results.append({"student": student['full_name'], "result": result})
-         except Exception as e:
-             logger.error(f"Error processing {student['photo']}: {e}")
-             results.append({"student": student['full_name'], "error": str(e)})
-    
-    return {"output": results}
+
+def _no_stage(name: str):
+    return nullcontext()
+
+
+def _render_student(school_id: str, student: dict, poster_path: str, output_folder: str, old_text: str, variants: list, stage=_no_stage) -> dict:
+    # Download (if needed) and render one student's poster
+    student_photo_path = photo_path(school_id, student['photo'])
+    with stage("download"):
+        if not os.path.exists(student_photo_path):
+            _downloadPhoto(school_id, student['photo'])
+    with stage("render"):
+        return replace_circle(student_photo_path, poster_path, output_folder, old_text, capitalize_name(student['full_name']), variants)
+
+
+@app.get("/posters/{school_id}/archive/{day}.zip")
+async def get_posters_zip_api(request: Request, school_id: str, day: date, old_text: str = DEFAULT_OLD_TEXT):
+    """
+    Stream a ZIP of the posters of every student whose birthday falls on `day`.
+    Posters are rendered in parallel and each one is added to the archive as soon as it finishes.
+    Every student's render takes its own render slot.
+    """
+    _check_school_id(school_id)
+    students = await run_in_threadpool(
+        execute_query,
+        f"select _uid, full_name, photo, dob from {school_id}.students where is_deleted = false and length(photo) > 0 and TO_CHAR(CAST(dob AS DATE), 'MM-DD') = %s",
+        (day.strftime("%m-%d"),)
+    )
+    if not students:
+        raise HTTPException(status_code=404, detail=f"No students with birthdays on {day}")
+
+    # Refuse up front if even the wait queue is full; each render then takes its own slot
+    admission.render.check()
+
+    poster_path = current_template(school_id, DEFAULT_TEMPLATE)
+    output_folder = output_dir(school_id, new_run_id(), day)
+    variants = await run_in_threadpool(get_school_variants, school_id)
+
+    # Set once the client is gone: renders still running stop at their next stage
+    cancel = threading.Event()
+
+    def render(student):
+        with deadline.scope(cancel=cancel):
+            return _render_student(school_id, student, poster_path, output_folder, old_text, variants)
+
+    async def stream():
+        sink = _ZipStream()
+        archive = zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_STORED)
+        waiting = list(students)
+        in_flight = {}
+        try:
+            while waiting or in_flight:
+                # At most ZIP_RENDER_WORKERS renders in flight, each holding its own render slot;
+                # the next student is started only once a finished poster has been written out
+                while waiting and len(in_flight) < ZIP_RENDER_WORKERS:
+                    student = waiting.pop(0)
+                    try:
+                        lease = await admission.render.acquire()
+                    except admission.Saturated as e:
+                        archive.writestr(f"errors/{student['_uid']}.txt", str(e))
+                        continue
+                    in_flight[asyncio.ensure_future(_run_leased(lease, render, student))] = student
+                if not in_flight:
+                    continue
+
+                done, _ = await asyncio.wait(in_flight, timeout=DISCONNECT_POLL_INTERVAL, return_when=asyncio.FIRST_COMPLETED)
+                if await request.is_disconnected():
+                    return
+                for future in done:
+                    student = in_flight.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logger.error(f"Error processing {student['photo']}: {e}")
+                        archive.writestr(f"errors/{student['_uid']}.txt", str(e))
+                    else:
+                        # PNGs are already compressed, store them as-is
+                        await run_in_threadpool(archive.write, result["file"], f"{student['_uid']}_{os.path.basename(result['file'])}")
+                if done:
+                    yield sink.drain()
+
+            # Central directory written on close
+            archive.close()
+            yield sink.drain()
+        finally:
+            # Client gone (disconnect seen here, or the stream was cancelled/closed by Starlette)
+            if waiting or in_flight:
+                logger.info(f"Archive download for {school_id}/{day} abandoned, cancelling {len(waiting) + len(in_flight)} renders")
+            cancel.set()
+
+    return StreamingResponse(
+        stream(),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{school_id}-{day}.zip"'}
+    )
+
+@app.post("/jobs/replace-circle/")
+async def submit_replace_circle_job_api(school_id: str = Form(...), poster: UploadFile = File(...), old_text: str = Form(DEFAULT_OLD_TEXT), post_to_facebook: bool = Form(False)) -> dict:
+    """
+    Same as /replace-circle/ but returns a job id right away; the batch runs in background workers.
+    Poll /jobs/{job_id} for per-student progress and results, or follow /jobs/{job_id}/events.
+    With post_to_facebook each poster is uploaded to the school's page as soon as it is rendered.
+    """
+    logger.info(f"Received job request with school_id: {school_id}, old_text: {old_text}")
+    _check_school_id(school_id)
+    run_id = new_run_id()
+    poster_path = _save_template(school_id, run_id, poster)
+    output_folder = output_dir(school_id, run_id)
+    credentials = {}
+
+    students = []
+
+    def prepare():
+        variants = get_school_variants(school_id)
+        students.extend((student, variants) for student in _get_birthday_students(school_id))
+        if post_to_facebook and students:
+            credentials["page_id"], credentials["access_token"] = get_page_access_token(school_id)
+        return students
+
+    def work(item, stage):
+        student, variants = item
+        # Shares the render slots with the HTTP endpoints (waits, never refused)
+        with admission.render.hold():
+            result = _render_student(school_id, student, poster_path, output_folder, old_text, variants, stage)
+        if post_to_facebook:
+            with stage("upload"), deadline.scope(seconds=REQUEST_DEADLINE):
+                result["facebook"] = upload_poster_once(school_id, credentials["page_id"], credentials["access_token"], result["file"])
+        return result
+
+    def complete(items):
+        entries = [
+            manifest_entry(school_id, student, item["result"])
+            for (student, _), item in zip(students, items) if item["status"] == "done"
+        ]
+        return {"run_id": run_id, "manifest": write_manifest(school_id, run_id, entries)}
+
+    job_id = submit_job(
+        {"school_id": school_id, "kind": "replace-circle"},
+        prepare,
+        work,
+        lambda item: item[0]['full_name'],
+        complete
+    )
+    return {"job_id": job_id, "status_url": f"/jobs/{job_id}", "events_url": f"/jobs/{job_id}/events"}
+
+@app.get("/jobs/{job_id}")
+async def get_job_api(job_id: str) -> dict:
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/jobs/{job_id}/events")
+async def get_job_events_api(request: Request, job_id: str):
+    """
+    Server-Sent Events stream of a job: stage_started / stage_finished (with duration)
+    for every student's download, render and upload, then item_finished and job_finished.
+    Reconnecting clients resume from the Last-Event-ID header.
+    """
+    if get_job(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    last_event_id = request.headers.get("last-event-id")
+    start = int(last_event_id) + 1 if last_event_id and last_event_id.isdigit() else 0
+
+    async def stream():
+        async for event in iter_events(job_id, start):
+            if event is None:
+                # Keep proxies from closing an idle connection
+                yield ": keep-alive\n\n"
+                continue
+            yield f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 @app.post("/post-on-facebook/")
-async def post_on_facebook_api() -> dict:
+async def post_on_facebook_api(school_id: str = Form("testschool"), mode: str = Form(None), run_id: str = Form(None)) -> dict:
+    """
+    Upload today's posters for the school, or only those of one run (`run_id` as returned by
+    the render endpoints). The manifest is always looked up under MANIFEST_DIR, never taken as a path.
+    """
     logger.info("Received request to post on Facebook")
+    _check_school_id(school_id)
+    try:
+        manifest = manifest_path(school_id, run_id) if run_id else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if manifest and not os.path.exists(manifest):
+        raise HTTPException(status_code=404, detail=f"No manifest for run {run_id} today")
+    deadline_at = time.monotonic() + REQUEST_DEADLINE
+
+    def post():
+        with deadline.scope(at=deadline_at):
+            return post_on_facebook(school_id, mode=mode, manifest_path=manifest)
+
     try:
-        response = post_on_facebook()
+        # Uploads and rate-limit pauses block; keep them off the event loop
+        response = await run_in_threadpool(post)
         return {"output": response}
+    except deadline.DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         logger.error(f"Error posting on Facebook: {e}")
         return {"error": str(e)}
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics_api() -> PlainTextResponse:
+    """
+    Prometheus scrape endpoint: render stage, DB, CDN, Graph API and HTTP histograms from
+    lib.metrics, plus gauges sampled now (render slots, render memory, DB pool, render cache).
+    """
+    metrics.set_gauge("render_slots_active", admission.render.active)
+    metrics.set_gauge("render_slots_queued", admission.render.queued)
+    metrics.set_gauge("render_memory_in_use_bytes", memory_governor.in_use())
+    metrics.set_gauge("render_memory_budget_bytes", memory_governor.RENDER_MEMORY_BUDGET)
+    db_pool = pool_stats()
+    for name in ("pool_size", "pool_available", "requests_waiting"):
+        metrics.set_gauge(f"db_{name}", db_pool.get(name, 0))
+    lookups = render_cache.stats["hits"] + render_cache.stats["misses"]
+    metrics.set_gauge("render_cache_hit_ratio", render_cache.stats["hits"] / lookups if lookups else 0)
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 if __name__ == "__main__":
     import argparse
     from lib.process_imag import replace_circle, capitalize_name, post_on_facebook
@@ -113,8 +555,24 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--run_birthday_pipeline", action="store_true")
+    parser.add_argument("--refresh_pages", action="store_true", help="Re-sync fb_pages.json and the page store from Graph API")
+    parser.add_argument("--download_workers", type=int, default=int(os.getenv("PIPELINE_DOWNLOAD_WORKERS", "4")))
+    parser.add_argument("--render_workers", type=int, default=int(os.getenv("PIPELINE_RENDER_WORKERS", str(os.cpu_count() or 2))))
+    parser.add_argument("--post_mode", choices=["single", "multi"], default=FB_POST_MODE)
+    parser.add_argument("--upload_workers", type=int, default=int(os.getenv("PIPELINE_UPLOAD_WORKERS", "2")))
     args = parser.parse_args()
 
+    if args.refresh_pages:
+        user_access_token = os.getenv("ACCESS_TOKEN")
+        if not user_access_token:
+            print("❌ ACCESS_TOKEN not found in environment.")
+            exit(1)
+        report = fetch_and_store_pages(user_access_token)
+        for page_id in report["added"]:
+            print(f"➕ {page_id}")
+        for page_id in report["removed"]:
+            print(f"➖ {page_id}")
+
     if args.run_birthday_pipeline:
         school_id = os.getenv("SCHOOL_ID")
         if not school_id:
@@ -124,37 +582,82 @@ if __name__ == "__main__":
         print(f"🎂 Running birthday poster generator for {school_id}")
 
         # 1️⃣ Fetch students with today's birthday
-        students = execute_query(f"""
-            SELECT full_name, photo, dob 
-            FROM {school_id}.students
-            WHERE is_deleted = false 
-            AND length(photo) > 0
-            AND TO_CHAR(CAST(dob AS DATE), 'MM-DD') = TO_CHAR(CURRENT_DATE, 'MM-DD')
-        """)
+        students = _get_birthday_students(school_id)
 
         if not students:
             print(f"ℹ No birthdays today for {school_id}")
             exit(0)
 
-        poster_path = "poster_template.jpg"  # ensure template exists
-        for student in students:
+        poster_path = DEFAULT_TEMPLATE  # ensure template exists
+        variants = get_school_variants(school_id)
+        run_id = new_run_id()
+        output_folder = output_dir(school_id, run_id)
+
+        # Get Page ID & Access Token for this school
+        page_id, access_token = get_page_access_token(school_id)
+
+        def download(student):
             print(f"🎉 {student['full_name']} — {student['dob']}")
             _downloadPhoto(school_id, student['photo'])
+            return student
+
+        def render(student):
             result = replace_circle(
-                f"uploads/{student['photo']}",
+                photo_path(school_id, student['photo']),
                 poster_path,
-                "outputs",
+                output_folder,
                 "www.reallygreatsite.com",
-                capitalize_name(student['full_name'])
+                capitalize_name(student['full_name']),
+                variants
             )
             print(f"✅ Poster generated: {result}")
-    # Get Page ID & Access Token for this school
-        page_id, access_token = get_page_access_token(school_id)
+            return result
+
+        def upload(result):
+            # Same per-upload budget as the API, so a stuck call or a long throttle pause gives up
+            with deadline.scope(seconds=REQUEST_DEADLINE):
+                if args.post_mode == "multi":
+                    # Attached to a single feed post once every poster is uploaded
+                    content_hash = render_cache.file_hash(result["file"])
+                    if not upload_ledger.claim(school_id, content_hash, result["file"]):
+                        print(f"⏭ {result['file']} already posted")
+                        return result
+                    try:
+                        result["photo_id"] = upload_unpublished_photo(page_id, access_token, result["file"])
+                    except BaseException:
+                        upload_ledger.release(school_id, content_hash)
+                        raise
+                else:
+                    result["facebook"] = upload_poster_once(school_id, page_id, access_token, result["file"])
+                    print(f"📦 Facebook response: {result['facebook']}")
+                return result
 
-    # Post all generated posters
-        post_on_facebook(output_folder="outputs", school_id=school_id)
+        # 2️⃣ Download, render and post on Facebook, all three stages running concurrently
+        print("📤 Generating and uploading to Facebook...")
+        outcomes = run_pipeline(students, [
+            ("download", download, args.download_workers),
+            ("render", render, args.render_workers),
+            ("upload", upload, args.upload_workers),
+        ])
+        manifest = write_manifest(school_id, run_id, [
+            manifest_entry(school_id, o["item"], o["value"]) for o in outcomes if o["value"].get("file")
+        ])
+        print(f"🧾 Run manifest: {manifest}")
+        for outcome in outcomes:
+            if outcome["error"]:
+                print(f"❌ {outcome['item']['full_name']} failed at {outcome['failed_stage']}: {outcome['error']}")
+        print(f"🎉 {sum(1 for o in outcomes if not o['error'])}/{len(outcomes)} posters posted")
 
-        # 2️⃣ Post on Facebook
-        print("📤 Uploading to Facebook...")
-        fb_result = post_on_facebook()
-        print(f"📦 Facebook response: {fb_result}")
+        if args.post_mode == "multi":
+            uploaded = [o["value"] for o in outcomes if not o["error"] and o["value"].get("photo_id")]
+            if uploaded:
+                try:
+                    with deadline.scope(seconds=REQUEST_DEADLINE):
+                        fb_result = publish_photos_post(page_id, access_token, [r["photo_id"] for r in uploaded])
+                except BaseException:
+                    for r in uploaded:
+                        upload_ledger.release(school_id, render_cache.file_hash(r["file"]))
+                    raise
+                for r in uploaded:
+                    upload_ledger.record(school_id, render_cache.file_hash(r["file"]), r["file"], fb_result.get("id"))
+                print(f"📦 Facebook response: {fb_result}")
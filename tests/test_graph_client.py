@@ -0,0 +1,96 @@
+import unittest
+from unittest import mock
+
+from lib import fake_graph
+from lib import graph_client
+from lib import rate_limit
+
+PAGE_ID = "100000"
+
+
+class GraphBatchTest(unittest.TestCase):
+    """
+    graph_batch against lib.fake_graph: results come back in operation order across chunks,
+    null (not executed) operations are retried, and a failed chunk only fails its own operations.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = fake_graph.serve(port=0)
+        cls.url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        fake_graph.reset()
+        # Unthrottled buckets, so 100+ operations do not wait on the real rates
+        patches = [
+            mock.patch.object(graph_client, "GRAPH_API_URL", self.url),
+            mock.patch.object(rate_limit, "_app_bucket", rate_limit.TokenBucket(10000, 10000)),
+            mock.patch.dict(rate_limit._page_buckets, {PAGE_ID: rate_limit.TokenBucket(10000, 10000)}),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def _posts(self, count: int) -> list:
+        return [
+            {"method": "POST", "relative_url": f"{PAGE_ID}/feed", "body": {"caption": f"poster {n}"}}
+            for n in range(count)
+        ]
+
+    def test_results_follow_operation_order_across_chunks(self):
+        operations = self._posts(graph_client.BATCH_LIMIT + 5)
+        unknown = graph_client.BATCH_LIMIT + 2
+        operations[3] = {"method": "GET", "relative_url": PAGE_ID}
+        operations[unknown] = {"method": "GET", "relative_url": "999"}
+
+        results = graph_client.graph_batch(operations, "TOKEN", PAGE_ID)
+
+        self.assertEqual(len(results), len(operations))
+        self.assertEqual(fake_graph.faults["batches"], 2)
+        self.assertEqual(results[3]["body"]["id"], PAGE_ID)
+        self.assertFalse(results[unknown]["ok"])
+        self.assertEqual(results[unknown]["code"], 404)
+        self.assertIn("Unknown object 999", results[unknown]["error"])
+        feed = [r for n, r in enumerate(results) if n not in (3, unknown)]
+        self.assertTrue(all(r["ok"] and r["body"]["id"].startswith(f"{PAGE_ID}_") for r in feed))
+        self.assertEqual(len({r["body"]["id"] for r in feed}), len(feed))
+
+    def test_operations_not_executed_are_retried(self):
+        fake_graph.faults["null_tail"] = {1: 3}
+
+        results = graph_client.graph_batch(self._posts(10), "TOKEN", PAGE_ID, retries=1)
+
+        self.assertTrue(all(r["ok"] for r in results))
+        self.assertEqual(fake_graph.faults["batches"], 2)
+        posted = [call for call in fake_graph.calls if call["path"].endswith("/feed")]
+        self.assertEqual(len(posted), 10)
+
+    def test_operations_still_not_executed_after_retries_fail(self):
+        fake_graph.faults["null_tail"] = {1: 3, 2: 1}
+
+        results = graph_client.graph_batch(self._posts(10), "TOKEN", PAGE_ID, retries=1)
+
+        self.assertTrue(all(r["ok"] for r in results[:9]))
+        self.assertFalse(results[9]["ok"])
+        self.assertEqual(results[9]["error"], "Operation was not executed by Graph API")
+
+    def test_failed_chunk_keeps_the_other_chunks(self):
+        fake_graph.faults["fail_batches"] = {2}
+        operations = self._posts(graph_client.BATCH_LIMIT + 10)
+
+        results = graph_client.graph_batch(operations, "TOKEN", PAGE_ID)
+
+        first, second = results[:graph_client.BATCH_LIMIT], results[graph_client.BATCH_LIMIT:]
+        self.assertTrue(all(r["ok"] for r in first))
+        self.assertTrue(all(not r["ok"] and r["code"] is None and "500" in r["error"] for r in second))
+        # A failed batch is not retried: some of its operations may have run
+        self.assertEqual(fake_graph.faults["batches"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()